@@ -2,15 +2,32 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 import argparse
+import errno
+import os
 import re
 import sys
 import time
 import json
+import gzip
 import yaml
 import random
+import socket
+import zlib
 import base64
+import fcntl
+import hmac
+import hashlib
+import tempfile
+import threading
+import itertools
+import math
+from array import array
+from collections import (namedtuple, OrderedDict, deque)
+from functools import partial
+from operator import gt
 from subprocess import check_output
-from os import (path, environ, getloadavg)
+from os import (path, environ, getloadavg, times, getpid, rename, stat,
+                unlink, urandom)
 from curses import wrapper
 
 
@@ -50,6 +67,25 @@ try:
 except ImportError:
     from urllib.parse import urlparse  # python 3
 
+try:
+    from BaseHTTPServer import (BaseHTTPRequestHandler, HTTPServer)
+    from SocketServer import (ThreadingMixIn, TCPServer,
+                              StreamRequestHandler)  # python 2
+except ImportError:
+    from http.server import (BaseHTTPRequestHandler, HTTPServer)
+    from socketserver import (ThreadingMixIn, TCPServer,
+                              StreamRequestHandler)  # python 3
+
+try:
+    from Queue import (Queue, Empty, Full)  # python 2
+except ImportError:
+    from queue import (Queue, Empty, Full)  # python 3
+
+try:
+    from time import monotonic  # python 3
+except ImportError:
+    from time import time as monotonic  # python 2
+
 
 # Url request timeout
 URL_TIMEOUT = 5
@@ -67,9 +103,87 @@ USERNAME = ""
 PASSWORD = ""
 BLINK_DELAY = 0.5
 POLL_DELAY = 2
+POOL_SIZE = 2
+# Time to fetch a command per poll, retries included. Default: URL_TIMEOUT
+POLL_BUDGET = None
+RETRY_BACKOFF = 0.1
+# Share of the remaining poll budget a request may take, leaving time
+# to retry it
+RETRY_TIMEOUT_SHARE = 0.5
+# Alternate endpoints of the node, requests are hedged to them
+ALTERNATES = []
+HEDGE_DELAY = 1.0
+HEDGE_MIN_DELAY = 0.05
+# Requests to an endpoint stop for BREAKER_COOLDOWN seconds after
+# BREAKER_FAILURES failed fetches in a row (retries included)
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 30
 OBSCURE_TOGGLE = 0
-ITER = 0
+# Windows to compute transaction rates over, and the
+# resolution of the samples kept for them
+RATE_WINDOWS = [('1m', 60), ('5m', 5 * 60), ('15m', 15 * 60)]
+RATE_RESOLUTION = 10
+# Time constants of the smoothed rates per neighbor
+EWMA_WINDOWS = [('1m', 60), ('5m', 5 * 60)]
+# Views of the neighbor counters, and how the table header names them
+COUNTER_VIEWS = [('absolute', ''), ('per-poll', 'tx per poll'),
+                 ('per-second', 'tx/s 1m (5m)')]
+# getNodeInfo fields written in headless mode
+NODE_RECORD = ['appName', 'appVersion', 'jreVersion']
+# Numeric getNodeInfo fields also written in headless mode
+NODE_SERIES = ['latestMilestoneIndex', 'latestSolidSubtangleMilestoneIndex',
+               'milestoneStartIndex', 'tips', 'transactionsToRequest',
+               'jreFreeMemory', 'jreTotalMemory', 'jreMaxMemory',
+               'neighbors', 'packetsQueueSize']
+NAN = float('nan')
+# Exporter metric names and help of getNodeInfo fields
+EXPORTER_NODE_METRICS = [
+    ('latestMilestoneIndex', 'iri_latest_milestone_index',
+     'Index of the latest milestone'),
+    ('latestSolidSubtangleMilestoneIndex', 'iri_latest_solid_milestone_index',
+     'Index of the latest solid milestone'),
+    ('milestoneStartIndex', 'iri_milestone_start_index',
+     'Index of the milestone the node started from'),
+    ('tips', 'iri_tips', 'Number of tips'),
+    ('transactionsToRequest', 'iri_transactions_to_request',
+     'Number of transactions to request'),
+    ('jreFreeMemory', 'iri_jre_free_memory_bytes', 'JRE free memory'),
+    ('jreTotalMemory', 'iri_jre_total_memory_bytes', 'JRE total memory'),
+    ('jreMaxMemory', 'iri_jre_max_memory_bytes', 'JRE max memory'),
+    ('neighbors', 'iri_neighbors', 'Number of neighbors'),
+    ('packetsQueueSize', 'iri_packets_queue_size', 'Packets queue size')]
+# Polls before neighbors without new transactions are flagged
+INCOMMUNICADO_POLLS = 3
+# Neighbors that left are forgotten after NEIGHBOR_TTL polls, or
+# earlier once more than NEIGHBOR_LIMIT neighbors are kept
+NEIGHBOR_TTL = 300
+NEIGHBOR_LIMIT = 1000
+# Neighbor events kept, and rows of the event panel
+EVENT_LOG_SIZE = 500
+EVENT_ROWS = 8
+FLEET_WORKERS = 32
+# How often viewers sharing a node check for a new snapshot
+SHARED_CHECK = 0.25
+# Messages queued for a slow viewer of an agent before it is sent the
+# whole snapshot again instead
+AGENT_BACKLOG = 100
+# Adaptive polling backs off when a poll keeps the node busy for more
+# than this fraction of the poll delay, or fails
+ADAPTIVE_LOAD = 0.1
+ADAPTIVE_BACKOFF = 2.0
+ADAPTIVE_RECOVERY = 0.8
+ADAPTIVE_JITTER = 0.1
+# Longest pause between two recorded polls when replaying, e.g.
+# across restarts of a recording iritop
+REPLAY_MAX_GAP = 60
+# Latency histogram buckets: one per ms up to LATENCY_EXACT ms, then
+# LATENCY_GROWTH times wider each, LATENCY_BUCKETS in all
+LATENCY_EXACT = 100
+LATENCY_GROWTH = 1.05
+LATENCY_BUCKETS = 300
 MB = 1024 * 1024
+# DEC private mode for synchronized terminal updates
+SYNC_UPDATE_MODE = 2026
 EXIT_MSG = ""
 
 
@@ -81,6 +195,11 @@ def parse_args():
     global OBSCURE_TOGGLE
     global USERNAME
     global PASSWORD
+    global POOL_SIZE
+    global POLL_BUDGET
+    global ALTERNATES
+    global BREAKER_FAILURES
+    global BREAKER_COOLDOWN
 
     parser = argparse.ArgumentParser(
         description='IRI Top status viewer',
@@ -102,12 +221,61 @@ def parse_args():
     parser.add_argument("-p", "--poll-delay", type=int,
                         help="node poll delay. Default: %ss" % POLL_DELAY)
 
+    parser.add_argument("--poll-schedule", type=poll_schedule,
+                        metavar='COMMAND=SECONDS,...',
+                        help="Poll delay per API command, e.g."
+                             " getNodeInfo=10. Other commands are"
+                             " polled too. Default: poll delay")
+
+    parser.add_argument("--adaptive-poll", type=delay_bounds,
+                        metavar='MIN,MAX',
+                        help="Adapt the poll delay to the response time"
+                             " of the node, between MIN and MAX seconds")
+
     parser.add_argument("-b", "--blink-delay", type=float,
                         help="blink delay. Default: %ss" % BLINK_DELAY)
 
     parser.add_argument("-t", "--url-timeout", type=int,
                         help="URL Timeout. Default: %ss" % URL_TIMEOUT)
 
+    parser.add_argument("--nodes", type=url, action='append',
+                        metavar='NODE',
+                        help="Show a summary of many nodes (fleet mode)."
+                             " Can be repeated, or a list in the"
+                             " configuration file")
+
+    parser.add_argument("--fleet-workers", type=int,
+                        help="Nodes polled at the same time in fleet"
+                             " mode. Default: %s" % FLEET_WORKERS)
+
+    parser.add_argument("--poll-budget", type=float,
+                        help="Time to fetch a command per poll, retries"
+                             " included. Default: URL timeout")
+
+    parser.add_argument("--breaker-failures", type=int, metavar='N',
+                        help="Stop requests to a node after N polls in a"
+                             " row failed to fetch a command."
+                             " Default: %s" % BREAKER_FAILURES)
+
+    parser.add_argument("--breaker-cooldown", type=float, metavar='SECONDS',
+                        help="Time requests to a node stay stopped."
+                             " Default: %ss" % BREAKER_COOLDOWN)
+
+    parser.add_argument("--alternate", type=url, action='append',
+                        metavar='NODE',
+                        help="Alternate address of the node (e.g. behind a"
+                             " reverse proxy). Slow requests are also sent"
+                             " there. Can be repeated")
+
+    parser.add_argument("--evict-after", type=int, metavar='POLLS',
+                        help="Forget neighbors that left POLLS polls ago."
+                             " Default: %s" % NEIGHBOR_TTL)
+
+    parser.add_argument("--max-neighbors", type=int, metavar='N',
+                        help="Forget the neighbors that left longest ago"
+                             " when more than N are kept."
+                             " Default: %s" % NEIGHBOR_LIMIT)
+
     parser.add_argument("-o", "--obscure-address", action='store_true',
                         help="Obscure addresses. Default: Off")
 
@@ -117,8 +285,57 @@ def parse_args():
     parser.add_argument("-P", "--password", type=str,
                         help="IRI Password if required.")
 
-    parser.add_argument("-s", "--sort", type=int,
-                        help="Sort column # (-# for reverse sorting)")
+    parser.add_argument("-s", "--sort", type=sort_columns,
+                        help="Sort column # (-# for reverse sorting)."
+                             " Separate more columns by comma to sort"
+                             " ties, e.g. 6,1")
+
+    parser.add_argument("--headless", action='store_true',
+                        help="Do not draw the screen, write one JSON record"
+                             " per poll to stdout instead")
+
+    parser.add_argument("--jsonl", type=str, metavar='FILE',
+                        help="Like --headless, but append the JSON records"
+                             " to FILE ('-' for stdout)")
+
+    parser.add_argument("--exporter", type=listen_address,
+                        metavar='[HOST:]PORT',
+                        help="Do not draw the screen, serve Prometheus"
+                             " metrics on PORT instead")
+
+    parser.add_argument("--agent", type=listen_address,
+                        metavar='[HOST:]PORT',
+                        help="Do not draw the screen, stream the changes"
+                             " of every poll to viewers connecting to PORT"
+                             " instead")
+
+    parser.add_argument("--viewer", type=listen_address,
+                        metavar='[HOST:]PORT',
+                        help="Show the node of the agent at HOST:PORT"
+                             " instead of polling the node")
+
+    parser.add_argument("--record", type=str, metavar='FILE',
+                        help="Append the raw node responses of every poll"
+                             " to FILE (gzip compressed)")
+
+    parser.add_argument("--replay", type=str, metavar='FILE',
+                        help="Replay the responses recorded in FILE"
+                             " instead of polling the node")
+
+    parser.add_argument("--speed", type=replay_speed,
+                        help="Replay speed, e.g. 10x. 0 replays as fast"
+                             " as possible. Default: 1x")
+
+    parser.add_argument("--shared-cache", type=str, nargs='?', const='',
+                        metavar='FILE',
+                        help="Share the snapshots of the node with other"
+                             " iritop instances through FILE, only one of"
+                             " them polls the node. Default FILE: in the"
+                             " temp directory, per node")
+
+    parser.add_argument("--pool-size", type=int,
+                        help="Keep-alive connections per node."
+                             " Default: %s" % POOL_SIZE)
 
     # Get configuration file if exists
     home_dir = path.expanduser("~")
@@ -127,6 +344,11 @@ def parse_args():
 
     args = parser.parse_args()
 
+    if args.nodes and (args.headless or args.jsonl or args.exporter or
+                       args.agent or args.viewer or args.replay or
+                       args.shared_cache is not None):
+        parser.error("Fleet mode (--nodes) only has the interactive view")
+
     # Check if both username and password are set
     if ((args.username and not args.password) or
             (args.password and not args.username)):
@@ -143,6 +365,24 @@ def parse_args():
         args.obscure_address = OBSCURE_TOGGLE
     if args.node is not None:
         NODE = args.node
+    if args.pool_size is not None:
+        POOL_SIZE = args.pool_size
+    if args.url_timeout is not None:
+        URL_TIMEOUT = args.url_timeout
+    if args.poll_budget is not None:
+        POLL_BUDGET = args.poll_budget
+    if args.breaker_failures is not None:
+        BREAKER_FAILURES = args.breaker_failures
+    if args.breaker_cooldown is not None:
+        BREAKER_COOLDOWN = args.breaker_cooldown
+    if args.alternate is not None:
+        ALTERNATES = args.alternate
+    if args.speed is None:
+        args.speed = 1.0
+    if args.evict_after is None:
+        args.evict_after = NEIGHBOR_TTL
+    if args.max_neighbors is None:
+        args.max_neighbors = NEIGHBOR_LIMIT
 
     return args
 
@@ -160,7 +400,8 @@ class LoadFromFile(argparse.Action):
 
             # Parse key values as arguments
             k = '--' + k.replace('_', '-')
-            parser.parse_args((k, str(v)), namespace=namespace)
+            for v in (v if isinstance(v, list) else [v]):
+                parser.parse_args((k, str(v)), namespace=namespace)
 
 
 letterPairs = [[ord('A'), ord('Z')],
@@ -168,25 +409,35 @@ letterPairs = [[ord('A'), ord('Z')],
                [ord('0'), ord('9')]]
 
 
-def scrambleCharacter(c):
+def scrambleCharacter(c, value):
+    """ Replace a letter or digit by the one value picks of its kind """
     ci = ord(c)
 
     for lp in letterPairs:
         if lp[0] <= ci <= lp[1]:
-            c = chr(random.randint(lp[0], lp[1]))
+            c = chr(lp[0] + value % (lp[1] - lp[0] + 1))
             break
 
     return c
 
 
-def scrambleAddress(addr):
-    p1 = addr.find(":")
+def scrambleAddress(addr, key):
+    """
+    Obscure the letters and digits of addr, except for a scheme://
+    prefix. The characters are picked by a hash of addr keyed by key,
+    so an address is always obscured the same way for the same key,
+    and cannot be guessed back without it.
+    """
+    scheme = addr.find("://")
+    start = scheme if scheme >= 0 else 0
 
-    addrOut = addr[:p1]
-    for c in addr[p1:]:
-        addrOut += scrambleCharacter(c)
+    digest = bytearray()
+    while len(digest) < len(addr) - start:
+        block = ('%d:%s' % (len(digest), addr)).encode('utf-8')
+        digest.extend(hmac.new(key, block, hashlib.sha256).digest())
 
-    return addrOut
+    return addr[:start] + ''.join(scrambleCharacter(c, value) for c, value
+                                  in zip(addr[start:], digest))
 
 
 def main():
@@ -201,8 +452,24 @@ def main():
     environ['LC_ALL'] = 'en_US.UTF-8'
     environ['LC_CTYPE'] = 'en_US.UTF-8'
 
+    if args.nodes:
+        wrapper(Fleet(args, args.nodes).run)
+        return
+
     iri_top = IriTop(args)
-    wrapper(iri_top.run)
+    if args.headless or args.jsonl or args.exporter or args.agent:
+        exporter = None
+        if args.exporter:
+            exporter = Exporter(*args.exporter)
+            exporter.start()
+        agent = None
+        if args.agent:
+            agent = Agent(*args.agent)
+            agent.start()
+        iri_top.run_headless(args.jsonl or ('-' if args.headless else None),
+                             exporter=exporter, agent=agent)
+    else:
+        wrapper(iri_top.run)
 
 
 def url(url):
@@ -223,10 +490,64 @@ def url(url):
         raise argparse.ArgumentTypeError("Invalid node URL")
 
 
+def listen_address(value):
+    host, sep, port = str(value).rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid port")
+    if not 0 < port < 65536:
+        raise argparse.ArgumentTypeError("Invalid port")
+    return host.strip('[]'), port
+
+
+def sort_columns(value):
+    try:
+        return [int(column) for column in str(value).split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid sort column(s)")
+
+
+def poll_schedule(value):
+    schedule = OrderedDict()
+    for item in str(value).split(','):
+        command, sep, seconds = item.strip().partition('=')
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            raise argparse.ArgumentTypeError("Invalid poll delay of '%s'" %
+                                             command)
+        if not re.match(r'^[A-Za-z]+$', command) or seconds <= 0:
+            raise argparse.ArgumentTypeError("Invalid poll schedule '%s'" %
+                                             item)
+        schedule[command] = seconds
+    return schedule
+
+
+def delay_bounds(value):
+    try:
+        bounds = [float(v) for v in str(value).split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid poll delay bounds")
+    if len(bounds) != 2 or not 0 < bounds[0] <= bounds[1]:
+        raise argparse.ArgumentTypeError("Invalid poll delay bounds")
+    return tuple(bounds)
+
+
+def replay_speed(value):
+    try:
+        speed = float(str(value).rstrip('xX'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid replay speed")
+    if speed < 0:
+        raise argparse.ArgumentTypeError("Invalid replay speed")
+    return speed
+
+
 def read_config(config_file):
     with open(config_file) as fh:
         try:
-            data = yaml.load(fh)
+            data = yaml.safe_load(fh)
         except yaml.parser.ParserError as e:
             raise Exception("Error parsing yaml configuration file '%s': %s" %
                             (config_file, e))
@@ -236,41 +557,1501 @@ def read_config(config_file):
     return data
 
 
-def fetch_data(data_to_send, method='POST', status_ok=200):
+class TimedConnectionMixin(object):
+    """ Report the duration of each new connection (TCP + TLS handshake) """
+
+    def __init__(self, *args, **kw):
+        self.on_connect = kw.pop('on_connect', None)
+        super(TimedConnectionMixin, self).__init__(*args, **kw)
+
+    def connect(self):
+        startTime = monotonic()
+        super(TimedConnectionMixin, self).connect()
+        if self.on_connect is not None:
+            self.on_connect(monotonic() - startTime)
+
+
+class NodeClient(object):
+    """
+    Long-lived keep-alive HTTP client for a single node
+
+    Connections are kept in a pool and reused between polls, so only
+    the first request (or one after the node dropped the connection)
+    pays for the TCP connect and TLS handshake.
+
+    The client is also a circuit breaker: after BREAKER_FAILURES failed
+    fetches in a row it is open and requests fail right away, until
+    BREAKER_COOLDOWN seconds later a request is let through again. A
+    fetch fails once all its retries failed, see fetch_retrying.
+    """
+
+    def __init__(self, node, pool_size=POOL_SIZE):
+        self.node = node
+        self.path = urlparse(node).path or '/'
+        self.requests = 0
+        self.connections = 0
+        self.handshake_time = 0.0
+        self.failures = 0
+        self.open_until = None
+        self.latency = RollingStats(100)
+
+        self.pool = urllib3.connection_from_url(node,
+                                                maxsize=pool_size,
+                                                block=False,
+                                                on_connect=self.log_connect)
+        conn_class = self.pool.ConnectionCls
+        self.pool.ConnectionCls = type('Timed' + conn_class.__name__,
+                                       (TimedConnectionMixin, conn_class),
+                                       {})
+
+    def log_connect(self, duration):
+        self.connections += 1
+        self.handshake_time += duration
+
+    @property
+    def reused(self):
+        return max(self.requests - self.connections, 0)
+
+    @property
+    def handshake_avg(self):
+        if self.connections == 0:
+            return 0
+        return int(self.handshake_time * 1000 / self.connections)
+
+    @property
+    def state(self):
+        if self.open_until is None:
+            return 'closed'
+        if monotonic() < self.open_until:
+            return 'open'
+        return 'half-open'
+
+    def succeeded(self, duration):
+        self.failures = 0
+        self.open_until = None
+        self.latency.add(int(duration * 1000))
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES:
+            self.open_until = monotonic() + BREAKER_COOLDOWN
+
+    def hedge_delay(self):
+        """ Time after which a request is also sent to alternates """
+        if len(self.latency.window) < 10:
+            return HEDGE_DELAY
+        return max(self.latency.percentile(95) / 1000, HEDGE_MIN_DELAY)
+
+    def request(self, method, body, headers, timeout):
+        self.requests += 1
+        return self.pool.urlopen(method,
+                                 self.path,
+                                 body=body,
+                                 headers=headers,
+                                 timeout=timeout,
+                                 retries=False)
+
+
+CLIENTS = {}
+# Commands are fetched from many threads, a node gets a single client
+CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(node=None):
+    """ Return the shared client for node, creating it on first use """
+    node = NODE if node is None else node
+    client = CLIENTS.get(node)
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(node)
+            if client is None:
+                client = CLIENTS[node] = NodeClient(node,
+                                                    pool_size=POOL_SIZE)
+    return client
+
+
+class ResponseError(Exception):
+    """ Node answered with an unexpected HTTP status """
+
+    def __init__(self, status, message):
+        super(ResponseError, self).__init__(message)
+        self.status = status
+
+    @property
+    def retry(self):
+        """ Whether the node may answer differently when asked again """
+        return self.status == 429 or self.status >= 500
+
+
+def fetch_data(data_to_send, method='POST', status_ok=200, node=None,
+               timeout=None, breaker=True):
+    """
+    Send data_to_send to node. Returns (data, error), raises
+    ResponseError on an error response. Failures count towards the
+    circuit breaker of the node unless breaker is False.
+    """
     global NODE
     global HEADERS
     global URL_TIMEOUT
 
-    http = urllib3.PoolManager()
-
+    client = get_client(NODE if node is None else node)
+    startTime = monotonic()
     try:
         data = json.dumps(data_to_send)
-        response = http.request(method,
-                                NODE,
-                                body=data,
-                                timeout=URL_TIMEOUT,
-                                headers=HEADERS)
+        response = client.request(method,
+                                  data,
+                                  HEADERS,
+                                  URL_TIMEOUT if timeout is None else timeout)
     except Exception as e:
+        if breaker:
+            client.failed()
         return None, 'Unknown error: %s' % e
 
     if response.status == status_ok:
+        client.succeeded(monotonic() - startTime)
         return json.loads(response.data.decode('utf-8')), None
     else:
-        raise Exception("Error response from node: code %d, response: '%s'" %
-                        (response.status, response.data))
+        error = ResponseError(response.status,
+                              "Error response from node: code %d,"
+                              " response: '%s'" %
+                              (response.status, response.data))
+        if error.retry and breaker:
+            client.failed()
+        raise error
+
+
+def fetch_retrying(data_to_send, node, deadline):
+    """
+    Fetch data_to_send from node, retrying failed requests with
+    exponential backoff until deadline. Returns (data, error).
+
+    A request may take RETRY_TIMEOUT_SHARE of the time left, so a hung
+    node is asked again. The fetch counts as a single failure towards
+    the circuit breaker, however many requests it took.
+    """
+    backoff = RETRY_BACKOFF
+    client = get_client(node)
+    while True:
+        if client.state == 'open':
+            return None, 'Circuit open: %s' % node
+        timeout = max((deadline - monotonic()) * RETRY_TIMEOUT_SHARE, 0.1)
+        try:
+            data, e = fetch_data(data_to_send, node=node, timeout=timeout,
+                                 breaker=False)
+        except ResponseError as ex:
+            if not ex.retry:
+                return None, '%s' % ex
+            data, e = None, '%s' % ex
+        if e is None:
+            return data, None
+
+        if monotonic() + backoff >= deadline:
+            client.failed()
+            return None, e
+        time.sleep(backoff)
+        backoff *= 2
+
+
+def fetch_resilient(data_to_send, node=None):
+    """
+    Fetch data_to_send from node (default: NODE) within POLL_BUDGET,
+    retries included. Returns (data, error).
+
+    With ALTERNATES the request to NODE is also sent to the alternates
+    when the node takes longer than usual (its p95) to answer, fails or
+    its circuit is open. The first response wins.
+    """
+    deadline = monotonic() + (URL_TIMEOUT if POLL_BUDGET is None
+                              else POLL_BUDGET)
+    if not ALTERNATES or node not in (None, NODE):
+        return fetch_retrying(data_to_send, node or NODE, deadline)
+
+    responses = Queue()
+
+    def worker(node):
+        responses.put(fetch_retrying(data_to_send, node, deadline))
+
+    def launch(nodes):
+        for node in nodes:
+            t = threading.Thread(target=worker, args=(node,))
+            t.daemon = True
+            t.start()
+        return len(nodes)
+
+    pending = launch([NODE])
+    hedged = False
+    error = 'Poll budget exceeded'
+    while pending:
+        timeout = max(deadline - monotonic(), 0)
+        if not hedged:
+            timeout = min(get_client(NODE).hedge_delay(), timeout)
+        try:
+            data, e = responses.get(timeout=timeout)
+        except Empty:
+            if hedged or monotonic() >= deadline:
+                break
+        else:
+            pending -= 1
+            if e is None:
+                return data, None
+            error = e
+        if not hedged and monotonic() < deadline:
+            hedged = True
+            pending += launch(ALTERNATES)
+    return None, error
+
+
+def fetch_concurrent(commands, fetch=fetch_resilient, node=None):
+    """
+    Send all commands to the node (default: NODE) in parallel
+
+    Returns a list of (data, error, duration_ms) in the order
+    of the commands, so that a poll takes as long as the slowest
+    call instead of the sum of all calls.
+    """
+    results = [None] * len(commands)
+
+    def worker(i):
+        startTime = monotonic()
+        try:
+            data, e = fetch(commands[i], node=node)
+        except Exception as ex:
+            data, e = None, '%s' % ex
+        results[i] = (data, e, int(round((monotonic() - startTime) * 1000)))
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(len(commands))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def sync_update_supported(term):
+    """ Ask the terminal whether it supports synchronized updates """
+    # Only available in recent versions of blessed
+    get_dec_mode = getattr(term, 'get_dec_mode', None)
+    if get_dec_mode is None:
+        return False
+    try:
+        return get_dec_mode(SYNC_UPDATE_MODE, timeout=0.2).supported
+    except Exception:
+        return False
+
+
+class Screen(object):
+    """
+    Off-screen frame buffer
+
+    Text is written to screen positions during a frame. On flush only
+    the text that changed since the previous frame is sent to the
+    terminal, together with any unchanged text that a change overlaps.
+
+    All changes of a frame are composed into one buffer and written
+    with a single write. When sync is set the buffer is wrapped in
+    synchronized update sequences, so the terminal shows the frame at
+    once instead of tearing half way through.
+    """
+
+    def __init__(self, term, stream=None, sync=False):
+        self.term = term
+        self.stream = sys.stdout if stream is None else stream
+        self.sync = sync
+        self.frame = OrderedDict()
+        self.prev = OrderedDict()
+        self.clear_pending = True
+        self.frame_bytes = 0
+
+    def write(self, row, col, text):
+        # Later writes to the same position replace earlier ones
+        self.frame.pop((row, col), None)
+        self.frame[(row, col)] = text
+
+    def invalidate(self):
+        """ Redraw everything on the next flush, e.g. after a resize """
+        self.clear_pending = True
+
+    def damage(self):
+        """ Return the (row, col, text) writes needed for this frame """
+        if self.clear_pending:
+            return [(None, None, self.term.clear)] + \
+                   [(row, col, text) for (row, col), text
+                    in self.frame.items()]
+
+        writes = []
+        dirty = {}
+
+        def mark(row, col, length):
+            dirty.setdefault(row, []).append((col, col + length))
+
+        # Blank text that is gone since the previous frame
+        for (row, col), text in self.prev.items():
+            if (row, col) not in self.frame:
+                length = self.term.length(text)
+                writes.append((row, col, " " * length))
+                mark(row, col, length)
+
+        for (row, col), text in self.frame.items():
+            old = self.prev.get((row, col))
+            if old != text:
+                length = self.term.length(text)
+                if old is not None:
+                    # Blank the remainder of longer previous text
+                    pad = self.term.length(old) - length
+                    if pad > 0:
+                        text += " " * pad
+                        length += pad
+                writes.append((row, col, text))
+                mark(row, col, length)
+            elif row in dirty:
+                # Unchanged, but possibly overwritten by a change
+                length = self.term.length(text)
+                if any(start < col + length and col < end
+                       for start, end in dirty[row]):
+                    writes.append((row, col, text))
+                    mark(row, col, length)
+
+        return writes
+
+    def flush(self):
+        """ Write the changes of this frame to the terminal """
+        buf = []
+        for row, col, text in self.damage():
+            if row is not None:
+                buf.append(self.term.move(row, col))
+            buf.append(text)
+
+        if buf and self.sync:
+            buf.insert(0, '\x1b[?%dh' % SYNC_UPDATE_MODE)
+            buf.append('\x1b[?%dl' % SYNC_UPDATE_MODE)
+
+        output = ''.join(buf)
+        self.frame_bytes = len(output.encode('utf-8'))
+        if output:
+            self.stream.write(output)
+            self.stream.flush()
+
+        self.prev = self.frame
+        self.frame = OrderedDict()
+        self.clear_pending = False
+        return self.frame_bytes
+
+
+class Neighbor(object):
+    """
+    A neighbor of the node, kept from poll to poll
+
+    Transaction counters are kept in arrays, in the order of the counter
+    keys passed to update, along with their delta since the previous
+    poll, the baseline and the values shown on the previous frame.
+    joined is the poll the neighbor (re)appeared in, reset whether its
+    counters went down on the last poll, e.g. as it reconnected.
+
+    rates are the counters per second since the previous poll, NaN
+    while unknown, i.e. right after the neighbor joined or reset. ewma
+    are the rates smoothed over each of EWMA_WINDOWS, NaN until the
+    first rate is known, and kept as is across resets.
+    """
+
+    __slots__ = ('id', 'address', 'connection_type', 'counters', 'deltas',
+                 'baseline', 'rates', 'ewma', 'shown', 'polled', 'joined',
+                 'reset', 'incommunicado')
+
+    def __init__(self, nid, address, connection_type, size):
+        self.id = nid
+        self.address = address
+        self.connection_type = connection_type
+        self.counters = array('l', [0] * size)
+        self.deltas = array('l', [0] * size)
+        self.baseline = array('l', [0] * size)
+        self.rates = array('d', [NAN] * size)
+        self.ewma = [array('d', [NAN] * size) for window in EWMA_WINDOWS]
+        self.shown = None
+        self.polled = None
+        self.joined = None
+        self.reset = False
+        self.incommunicado = False
+
+    def update(self, data, keys, poll, dt=0, alphas=()):
+        """
+        Set the counters from getNeighbors data and their deltas, and
+        the rates if dt, the seconds since the previous poll, is set.
+        alphas are the weights of the rates in each ewma.
+        """
+        # No deltas for a neighbor that was not there on the last poll
+        fresh = self.polled != poll - 1
+        counters, deltas, rates = self.counters, self.deltas, self.rates
+        for i, key in enumerate(keys):
+            count = data.get(key, 0)
+            deltas[i] = 0 if fresh else count - counters[i]
+            counters[i] = count
+        self.reset = min(deltas) < 0
+        self.polled = poll
+
+        if fresh or self.reset:
+            # Counters started over, e.g. as the neighbor reconnected
+            rates[:] = array('d', [NAN] * len(rates))
+            if fresh:
+                self.joined = poll
+                for ewma in self.ewma:
+                    ewma[:] = rates
+            return
+        if dt <= 0:
+            return
+
+        rates[:] = array('d', [delta / dt for delta in deltas])
+        for ewma, alpha in zip(self.ewma, alphas):
+            if ewma[0] != ewma[0]:
+                # The first rate starts the average
+                ewma[:] = rates
+            else:
+                ewma[:] = array('d', [average + alpha * (rate - average)
+                                      for average, rate in zip(ewma, rates)])
+
+
+# Change of a neighbor between two polls: joined, left, reset,
+# incommunicado or communicating
+Event = namedtuple('Event', ['timestamp', 'kind', 'address',
+                             'connection_type'])
+
+
+class SeriesStore(object):
+    """
+    Ring buffer with the last samples of all neighbor counters
+
+    A sample is one array row holding a slot of counters per neighbor.
+    Rows are overwritten in place once the ring is full, and slots of
+    neighbors that left are reused once they aged out of all rows, so
+    memory stays bounded however long iritop runs. Neighbors missing
+    from a sample are NaN, as are the older samples of a neighbor whose
+    counters went down, e.g. as it reconnected.
+
+    The newest sample is replaced on each poll until it is resolution
+    seconds newer than the one before it, so the ring covers a fixed
+    time span whatever the poll delay.
+    """
+
+    def __init__(self, counters, span, resolution):
+        self.size = int(span // resolution) + 2
+        self.resolution = resolution
+        self.counters = counters
+        self.times = array('d', [NAN] * self.size)
+        self.rows = [array('d') for i in range(self.size)]
+        self.count = 0
+        self.width = 0
+        self.blank = array('d')
+        self.slots = dict()
+        self.seen = dict()
+        self.free = []
+
+    @property
+    def nbytes(self):
+        """ Bytes of the samples """
+        return self.size * (self.width + 1) * self.times.itemsize
+
+    def position(self, i):
+        """ Ring position of the i-th newest sample, 0 being the newest """
+        return (self.count - 1 - i) % self.size
+
+    def slot(self, nid):
+        """ Return the slot of a neighbor, allocating one if needed """
+        slot = self.slots.get(nid)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = self.width // self.counters
+                self.width += self.counters
+                nans = array('d', [NAN] * self.counters)
+                self.blank.extend(nans)
+                for row in self.rows:
+                    row.extend(nans)
+            self.slots[nid] = slot
+        return slot
+
+    def sample(self, time, neighbors):
+        if (self.count < 2 or
+                self.times[self.position(0)] -
+                self.times[self.position(1)] >= self.resolution):
+            self.count += 1
+        pos = self.position(0)
+
+        # Release slots of neighbors that aged out of all rows
+        for nid, seen in list(self.seen.items()):
+            if self.count - seen >= self.size:
+                self.free.append(self.slots.pop(nid))
+                del self.seen[nid]
+
+        k = self.counters
+        slots = [self.slot(neighbor.id) for neighbor in neighbors]
+        slots = [slice(slot * k, (slot + 1) * k) for slot in slots]
+        samples = [array('d', neighbor.counters) for neighbor in neighbors]
+        for neighbor, slot, new in zip(neighbors, slots, samples):
+            seen = self.seen.get(neighbor.id)
+            if (seen is not None and
+                    any(map(gt, self.rows[(seen - 1) % self.size][slot],
+                            new))):
+                # Counters started over, older samples would make the
+                # rates negative
+                for row in self.rows:
+                    row[slot] = self.blank[slot]
+
+        row = self.rows[pos]
+        row[:] = self.blank
+        for neighbor, slot, new in zip(neighbors, slots, samples):
+            row[slot] = new
+            self.seen[neighbor.id] = self.count
+
+        self.times[pos] = time
+
+    def window(self, seconds):
+        """
+        Return the ring position of the newest sample at least seconds
+        older than the newest one, or of the oldest sample
+        """
+        n = min(self.count, self.size)
+        if n < 2:
+            return None
+        target = self.times[self.position(0)] - seconds
+        lo, hi = 1, n - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[self.position(mid)] <= target:
+                hi = mid
+            else:
+                lo = mid + 1
+        return self.position(lo)
+
+    def total_rate(self, seconds, counter=0):
+        """ Rate of a counter summed over all neighbors """
+        old = self.window(seconds)
+        if old is None:
+            return None
+        new = self.position(0)
+        k = self.counters
+        # Only the column of the counter, one value per slot
+        deltas = [x - y for x, y in zip(self.rows[new][counter::k],
+                                        self.rows[old][counter::k])]
+        # NaN for neighbors missing from one of the samples
+        return (sum(d for d in deltas if d == d) /
+                (self.times[new] - self.times[old]))
+
+
+class RollingStats(object):
+    """
+    Rolling window of durations in ms
+
+    The window is also counted in a histogram of fixed buckets (see
+    LATENCY_EXACT), so adding a value and reading a percentile cost
+    the same whatever the size of the window. Percentiles are exact
+    up to LATENCY_EXACT and within LATENCY_GROWTH above. The mean is
+    kept as a running sum and the max in a monotonic queue.
+    """
+
+    def __init__(self, size):
+        self.window = deque(maxlen=max(int(size), 1))
+        self.counts = [0] * LATENCY_BUCKETS
+        # Decreasing values of the window, the max first
+        self.maxima = deque()
+        self.total = 0
+        self.last = 0
+
+    @staticmethod
+    def bucket(value):
+        """ Index of the bucket counting value """
+        if value <= LATENCY_EXACT:
+            return max(int(math.ceil(value)), 0)
+        index = LATENCY_EXACT + int(math.ceil(
+            math.log(value / LATENCY_EXACT, LATENCY_GROWTH)))
+        return min(index, LATENCY_BUCKETS - 1)
+
+    @staticmethod
+    def bound(index):
+        """ Largest value counted in the bucket at index """
+        if index <= LATENCY_EXACT:
+            return index
+        if index == LATENCY_BUCKETS - 1:
+            # Counts all longer durations
+            return float('inf')
+        return int(math.ceil(LATENCY_EXACT *
+                             LATENCY_GROWTH ** (index - LATENCY_EXACT)))
+
+    def add(self, value):
+        if len(self.window) == self.window.maxlen:
+            old = self.window.popleft()
+            self.total -= old
+            self.counts[self.bucket(old)] -= 1
+            if self.maxima[0] == old:
+                self.maxima.popleft()
+        self.window.append(value)
+        self.total += value
+        self.counts[self.bucket(value)] += 1
+        while self.maxima and self.maxima[-1] < value:
+            self.maxima.pop()
+        self.maxima.append(value)
+        self.last = value
+
+    @property
+    def mean(self):
+        if not self.window:
+            return 0
+        return int(self.total / len(self.window))
+
+    @property
+    def max(self):
+        return self.maxima[0] if self.maxima else 0
+
+    def percentile(self, p):
+        """ Nearest rank percentile of the window """
+        if not self.window:
+            return 0
+        rank = max(int(-(-p * len(self.window) // 100)), 1)
+        # Walk down from the max, the percentiles shown are high ones
+        index = self.bucket(self.max)
+        below = len(self.window) - self.counts[index]
+        while below >= rank:
+            index -= 1
+            below -= self.counts[index]
+        return min(self.bound(index), self.max)
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.metrics
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ExporterServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    metrics = b''
+
+
+class Exporter(threading.Thread):
+    """
+    Serve the metrics of the last snapshot in Prometheus text format
+
+    Scrapes are answered from the metrics published after each poll and
+    never call the node, so polling does not depend on how many scrapers
+    there are or how often they scrape.
+    """
+
+    def __init__(self, host, port):
+        super(Exporter, self).__init__()
+        self.daemon = True
+        self.httpd = ExporterServer((host, port), ExporterHandler)
+
+    def publish(self, metrics):
+        self.httpd.metrics = metrics.encode('utf-8')
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def metric_name(key):
+    """ Metric name of a field, e.g. numberOfAllTransactions is
+        all_transactions """
+    name = re.sub(r'([A-Z])', r'_\1', key.replace('numberOf', '', 1))
+    return name.strip('_').lower()
+
+
+def metric_labels(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                 .replace('"', '\\"').replace('\n', '\\n'))
+                    for k, v in labels)
+
+
+# Result of a single poll. Never modified once published by the poller.
+# time is monotonic, timestamp the wall clock time.
+Snapshot = namedtuple('Snapshot', ['results', 'duration', 'time',
+                                   'timestamp'])
+
+
+class Poller(threading.Thread):
+    """
+    Background thread polling the node every poll_delay seconds, or
+    every command at its own interval if intervals is set
+
+    Snapshots are published through a queue, so a slow or unresponsive
+    node never blocks the render and keyboard loop. Commands that were
+    not due have a result of None in the snapshot.
+
+    With bounds (min, max) the delays are scaled between those bounds
+    by the health of the node, see adapt.
+    """
+
+    # Role in sharing snapshots with other instances, see SharedPoller
+    role = None
+    # Why the poller works differently than asked, shown to the user
+    notice = None
+
+    def __init__(self, commands, poll_delay, fetch=fetch_concurrent,
+                 recorder=None, intervals=None, bounds=None):
+        super(Poller, self).__init__()
+        self.daemon = True
+        self.commands = commands
+        self.poll_delay = poll_delay
+        self.intervals = intervals or [poll_delay] * len(commands)
+        self.fetch = fetch
+        self.recorder = recorder
+        self.bounds = bounds
+        # Shortest delay between polls
+        self.delay = min(self.intervals)
+        if bounds is not None:
+            self.delay = min(max(self.delay, bounds[0]), bounds[1])
+        self.jitter = random.Random()
+        self.next_poll = [0] * len(commands)
+        self.snapshots = Queue()
+        self.polling_since = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(max(self.poll() - monotonic(), 0))
+
+    def poll(self):
+        """ Poll the commands that are due, return when the next are due """
+        self.polling_since = startTime = monotonic()
+        # Poll commands that are almost due together with the others
+        due = [i for i, t in enumerate(self.next_poll)
+               if t <= startTime + self.delay / 4]
+        fetched = self.fetch([self.commands[i] for i in due])
+        endTime = monotonic()
+        self.polling_since = None
+
+        results = [None] * len(self.commands)
+        for i, result in zip(due, fetched):
+            results[i] = result
+        duration = int(round((endTime - startTime) * 1000))
+
+        scale = 1.0
+        if self.bounds is not None:
+            self.adapt(fetched, duration)
+            scale = self.delay / min(self.intervals)
+        for i in due:
+            delay = self.intervals[i] * scale
+            if self.bounds is not None:
+                delay *= 1 + self.jitter.uniform(-ADAPTIVE_JITTER,
+                                                 ADAPTIVE_JITTER)
+            self.next_poll[i] = startTime + delay
+
+        self.publish(Snapshot(
+            results=tuple(results),
+            duration=duration,
+            time=endTime,
+            timestamp=time.time()))
+
+        return min(self.next_poll)
+
+    def adapt(self, results, duration):
+        """
+        Back off when the node fails or a poll keeps it busy for more
+        than ADAPTIVE_LOAD of the delay, speed up again when it is healthy
+        """
+        if (any(e is not None for data, e, ms in results) or
+                duration > ADAPTIVE_LOAD * self.delay * 1000):
+            self.delay = min(self.delay * ADAPTIVE_BACKOFF, self.bounds[1])
+        else:
+            self.delay = max(self.delay * ADAPTIVE_RECOVERY, self.bounds[0])
+
+    def publish(self, snapshot):
+        if self.recorder is not None:
+            self.recorder.write(self.commands, snapshot)
+        self.snapshots.put(snapshot)
+
+    def clock(self):
+        """ Time on the clock of the snapshots """
+        return monotonic()
+
+    def stop(self):
+        self.stopped.set()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def drain(self):
+        """ Return all snapshots published since the last call """
+        snapshots = []
+        while True:
+            try:
+                snapshots.append(self.snapshots.get_nowait())
+            except Empty:
+                return snapshots
+
+
+class Recorder(object):
+    """
+    Append the raw responses of every poll to a gzip compressed
+    file, one JSON record per line
+
+    Every record is flushed, so that the file can be replayed up to
+    the last poll even if iritop did not exit cleanly. Recording again
+    to the same file appends another gzip member.
+    """
+
+    def __init__(self, filename):
+        self.file = gzip.open(filename, 'ab')
+        self.lock = threading.Lock()
+
+    def write(self, commands, snapshot):
+        record = {'timestamp': round(snapshot.timestamp, 3),
+                  'duration': snapshot.duration,
+                  'commands': [c['command'] for c in commands],
+                  'results': snapshot.results}
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(line.encode('utf-8'))
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_recording(filename):
+    """ Yield the records of a recording, up to the first damaged one """
+    with gzip.open(filename, 'rb') as f:
+        try:
+            for line in f:
+                yield json.loads(line.decode('utf-8'))
+        except (EOFError, IOError, ValueError):
+            # Recording was cut off
+            return
+
+
+def record_results(commands, record, missing=None):
+    """
+    Results of a record in the order of commands. Commands missing
+    in the record are an error with the message missing, or not
+    polled (None) if missing is None.
+    """
+    recorded = dict(zip(record['commands'], record['results']))
+    results = []
+    for c in commands:
+        result = recorded.get(c['command'], ())
+        if result == () and missing is not None:
+            result = (None, missing % c['command'], 0)
+        results.append(tuple(result) if result else None)
+    return tuple(results)
+
+
+class ReplayPoller(Poller):
+    """
+    Poller publishing the snapshots of a recording instead of
+    polling the node
+
+    Snapshots keep their recorded spacing, divided by speed (0 means
+    as fast as possible). The clock of the snapshots runs on recorded
+    time, so rates come out as they were on the node whatever the speed.
+    """
+
+    def __init__(self, commands, poll_delay, filename, speed=1.0,
+                 recorder=None):
+        super(ReplayPoller, self).__init__(commands, poll_delay,
+                                           recorder=recorder)
+        self.filename = filename
+        self.speed = speed
+        self.start_time = monotonic()
+        self.replay_time = self.start_time
+
+    def clock(self):
+        if self.speed <= 0:
+            return self.replay_time
+        return self.start_time + (monotonic() - self.start_time) * self.speed
+
+    def results(self, record):
+        """ Results in the order of our commands """
+        return record_results(self.commands, record, 'Not recorded: %s')
+
+    def run(self):
+        previous = None
+        for record in read_recording(self.filename):
+            if previous is not None:
+                self.replay_time += min(max(record['timestamp'] - previous,
+                                            0), REPLAY_MAX_GAP)
+            previous = record['timestamp']
+
+            if self.speed > 0:
+                self.polling_since = monotonic()
+                self.stopped.wait(max(self.replay_time - self.clock(), 0) /
+                                  self.speed)
+                self.polling_since = None
+            if self.stopped.is_set():
+                return
+
+            self.publish(Snapshot(results=self.results(record),
+                                  duration=record['duration'],
+                                  time=self.replay_time,
+                                  timestamp=record['timestamp']))
+
+
+def shared_cache_file(node):
+    """ Default snapshot file shared by the viewers of node """
+    return path.join(tempfile.gettempdir(), 'iritop-%s.snapshot' %
+                     hashlib.sha1(node.encode('utf-8')).hexdigest()[:12])
+
+
+class SharedPoller(Poller):
+    """
+    Poller sharing the snapshots of a node with other iritop instances
+    on the same host, so that only one of them polls the node
+
+    The instance holding a lock on filename.lock is the leader: it polls
+    the node and replaces filename with each snapshot. The others follow
+    the file instead of polling, and one of them takes over the lock
+    when the leader exits.
+
+    Instances may run as different users: the lock is taken on a read
+    only descriptor and snapshots are readable by everyone. An instance
+    that cannot open the lock or write the snapshots (e.g. a file left
+    by another user in a sticky temp directory) polls the node on its
+    own, and says why in notice.
+    """
+
+    def __init__(self, commands, poll_delay, filename, node, **kw):
+        super(SharedPoller, self).__init__(commands, poll_delay, **kw)
+        self.filename = filename
+        self.node = node
+        self.leader = False
+        self.seq = 0
+        # (pid, seq) of the last snapshot published
+        self.last = None
+        self.seen = None
+        try:
+            self.lock_fd = os.open(filename + '.lock',
+                                   os.O_RDONLY | os.O_CREAT | os.O_NOFOLLOW,
+                                   0o666)
+        except OSError as e:
+            self.lock_fd = None
+            self.unshare(e)
+
+    @property
+    def role(self):
+        if self.lock_fd is None:
+            return 'off'
+        return 'leader' if self.leader else 'follower'
+
+    def unshare(self, error):
+        """ Poll the node on our own from now on """
+        self.notice = 'Not sharing snapshots: %s' % error
+        self.leader = True
+        if self.lock_fd is not None:
+            # Releases the lock for a follower to take over
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def elect(self):
+        """ Become the leader if there is none """
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError, ValueError):
+            return False
+        self.leader = True
+        return True
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.leader or self.elect():
+                self.stopped.wait(max(self.poll() - monotonic(), 0))
+            else:
+                self.follow()
+                self.stopped.wait(min(SHARED_CHECK, self.delay / 4))
+
+    def publish(self, snapshot):
+        super(SharedPoller, self).publish(snapshot)
+        if self.leader and self.lock_fd is not None:
+            self.seq += 1
+            record = {'pid': getpid(),
+                      'seq': self.seq,
+                      'node': self.node,
+                      'timestamp': snapshot.timestamp,
+                      'duration': snapshot.duration,
+                      'delay': self.delay,
+                      'commands': [c['command'] for c in self.commands],
+                      'results': snapshot.results}
+            # Replace the file at once, followers never read half of it.
+            # The temporary file gets a new name that cannot be planted
+            # in a shared directory, e.g. as a symlink to another file.
+            tmp = None
+            try:
+                fd, tmp = tempfile.mkstemp(
+                    dir=path.dirname(path.abspath(self.filename)),
+                    prefix=path.basename(self.filename) + '.',
+                    suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    # Readable by followers of other users, whatever
+                    # the umask
+                    os.fchmod(f.fileno(), 0o644)
+                    json.dump(record, f, separators=(',', ':'))
+                rename(tmp, self.filename)
+            except (IOError, OSError) as e:
+                if tmp is not None:
+                    try:
+                        unlink(tmp)
+                    except OSError:
+                        pass
+                self.unshare(e)
+
+    def follow(self):
+        """ Publish the snapshot of the leader if it is a new one """
+        try:
+            st = stat(self.filename)
+            if (st.st_ino, st.st_mtime) == self.seen:
+                return
+            with open(self.filename) as f:
+                record = json.load(f)
+            self.seen = (st.st_ino, st.st_mtime)
+        except (IOError, OSError, ValueError):
+            return
+
+        if (record['node'] != self.node or
+                (record['pid'], record['seq']) == self.last):
+            return
+        self.last = (record['pid'], record['seq'])
+        self.delay = record['delay']
+
+        # Age of the snapshot on our own clock
+        age = max(time.time() - record['timestamp'], 0)
+        super(SharedPoller, self).publish(Snapshot(
+            results=record_results(self.commands, record),
+            duration=record['duration'],
+            time=monotonic() - age,
+            timestamp=record['timestamp']))
+
+    def stop(self):
+        super(SharedPoller, self).stop()
+        if self.lock_fd is None:
+            return
+        if self.leader:
+            try:
+                unlink(self.filename)
+            except OSError:
+                pass
+        # Releases the lock for a follower to take over
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+
+def neighbor_list(value):
+    """ Whether value is a list of neighbors, encoded by address """
+    return isinstance(value, list) and all(
+        isinstance(n, dict) and 'address' in n for n in value)
+
+
+class DeltaEncoder(object):
+    """
+    Encode snapshots as the changes since the last one encoded
+
+    Only the fields of a command that changed are sent. Lists of
+    neighbors are keyed by address: only the counters that changed are
+    sent per neighbor, and the order of the addresses only when
+    neighbors came, left or moved. The first message is sent in full.
+    """
+
+    def __init__(self):
+        # Data last sent per command, neighbor lists by address
+        self.state = {}
+        self.full = True
+
+    def encode(self, commands, snapshot, **fields):
+        results = []
+        for command, result in zip(commands, snapshot.results):
+            if result is not None:
+                result = self.delta(command['command'], *result)
+            results.append(result)
+        message = {'commands': [c['command'] for c in commands],
+                   'time': snapshot.time,
+                   'timestamp': round(snapshot.timestamp, 3),
+                   'duration': snapshot.duration,
+                   'results': results}
+        message.update(fields)
+        if self.full:
+            message['full'] = True
+            self.full = False
+        return message
+
+    def delta(self, command, data, error, duration):
+        if error is not None or not isinstance(data, dict):
+            # Sent as is, the next data of the command in full
+            self.state.pop(command, None)
+            return {'error': error, 'data': data, 'ms': duration}
+
+        old = self.state.get(command, {})
+        new = {}
+        delta = {'ms': duration}
+        for key, value in data.items():
+            if neighbor_list(value):
+                value = OrderedDict((n['address'], n) for n in value)
+                change = self.neighbors(old.get(key), value)
+                if change:
+                    delta.setdefault('lists', {})[key] = change
+            elif key not in old or old[key] != value:
+                delta.setdefault('set', {})[key] = value
+            new[key] = value
+        unset = [key for key in old if key not in data]
+        if unset:
+            delta['unset'] = unset
+        self.state[command] = new
+        return delta
+
+    def neighbors(self, old, new):
+        """ Changes of the neighbors old (if a list before) to new """
+        change = {}
+        if not isinstance(old, OrderedDict):
+            old = None
+            change['order'] = list(new)
+        elif list(old) != list(new):
+            change['order'] = list(new)
+
+        for address, neighbor in new.items():
+            previous = {} if old is None else old.get(address, {})
+            fields = dict((k, v) for k, v in neighbor.items()
+                          if k not in previous or previous[k] != v)
+            if fields:
+                change.setdefault('set', {})[address] = fields
+        return change
+
+
+class DeltaDecoder(object):
+    """ Rebuild the records of the messages of a DeltaEncoder """
+
+    def __init__(self):
+        self.state = {}
+
+    def decode(self, message):
+        if message.get('full'):
+            self.state.clear()
+        results = []
+        for command, delta in zip(message['commands'], message['results']):
+            if delta is not None:
+                delta = self.apply(command, delta)
+            results.append(delta)
+        record = dict(message)
+        record['results'] = results
+        return record
+
+    def apply(self, command, delta):
+        if 'error' in delta:
+            self.state.pop(command, None)
+            return (delta['data'], delta['error'], delta['ms'])
+
+        state = self.state.setdefault(command, {})
+        for key in delta.get('unset', ()):
+            state.pop(key, None)
+        state.update(delta.get('set', {}))
+        for key, change in delta.get('lists', {}).items():
+            old = state.get(key)
+            if not isinstance(old, OrderedDict):
+                old = OrderedDict()
+            neighbors = OrderedDict((address, old.get(address, {}))
+                                    for address in change.get('order', old))
+            # New dicts, the neighbors of published snapshots never change
+            for address, fields in change.get('set', {}).items():
+                neighbor = dict(neighbors.get(address, {}))
+                neighbor.update(fields)
+                neighbors[address] = neighbor
+            state[key] = neighbors
+
+        data = dict((key, list(value.values())
+                     if isinstance(value, OrderedDict) else value)
+                    for key, value in state.items())
+        return (data, None, delta['ms'])
+
+
+class AgentHandler(StreamRequestHandler):
+    """ Stream the messages of the agent to a viewer """
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        agent = self.server.agent
+        messages = agent.connect()
+        # One compression stream per connection, each message flushed
+        compressor = zlib.compressobj()
+        try:
+            while not agent.stopped.is_set():
+                try:
+                    lines = [messages.get(timeout=1)]
+                except Empty:
+                    continue
+                while True:
+                    try:
+                        lines.append(messages.get_nowait())
+                    except Empty:
+                        break
+                self.wfile.write(compressor.compress(b''.join(lines)) +
+                                 compressor.flush(zlib.Z_SYNC_FLUSH))
+        except (IOError, OSError):
+            # Viewer went away
+            pass
+        finally:
+            agent.disconnect(messages)
+
+
+class AgentServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Agent(threading.Thread):
+    """
+    Stream the snapshots of the node to viewers over TCP, see
+    DeltaEncoder
+
+    Messages are encoded once for all viewers. A viewer that connects,
+    or falls AGENT_BACKLOG messages behind, is sent the latest result of
+    every command in full and follows the changes from there.
+    """
+
+    def __init__(self, host, port, node=None):
+        super(Agent, self).__init__()
+        self.daemon = True
+        self.node = NODE if node is None else node
+        self.server = AgentServer((host, port), AgentHandler)
+        self.server.agent = self
+        self.encoder = DeltaEncoder()
+        self.viewers = []
+        # Latest commands, snapshot with the latest result of each
+        # command and poll delay
+        self.latest = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def message(self, encoder, commands, snapshot, delay):
+        message = encoder.encode(commands, snapshot, delay=delay,
+                                 node=self.node)
+        return (json.dumps(message, separators=(',', ':')) +
+                '\n').encode('utf-8')
+
+    def resync(self, messages):
+        """ Queue the latest results in full """
+        if self.latest is not None:
+            messages.put(self.message(DeltaEncoder(), *self.latest))
+
+    def connect(self):
+        messages = Queue(maxsize=AGENT_BACKLOG)
+        with self.lock:
+            self.resync(messages)
+            self.viewers.append(messages)
+        return messages
+
+    def disconnect(self, messages):
+        with self.lock:
+            if messages in self.viewers:
+                self.viewers.remove(messages)
+
+    def publish(self, commands, snapshot, delay):
+        with self.lock:
+            results = list(snapshot.results)
+            if self.latest is not None and self.latest[0] == commands:
+                for i, result in enumerate(self.latest[1].results):
+                    if results[i] is None:
+                        results[i] = result
+            self.latest = (commands, snapshot._replace(results=tuple(results)),
+                           delay)
+
+            line = self.message(self.encoder, commands, snapshot, delay)
+            for messages in self.viewers:
+                try:
+                    messages.put_nowait(line)
+                except Full:
+                    while True:
+                        try:
+                            messages.get_nowait()
+                        except Empty:
+                            break
+                    self.resync(messages)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ViewerPoller(Poller):
+    """
+    Poller receiving the snapshots of an agent instead of polling
+    the node
+
+    The clock of the agent is mapped to ours when connecting, so that
+    the snapshots keep the spacing of the polls on the agent. Lost
+    connections are published as a failed poll and retried every
+    poll delay.
+    """
+
+    role = 'viewer'
+
+    def __init__(self, commands, poll_delay, host, port, recorder=None):
+        super(ViewerPoller, self).__init__(commands, poll_delay,
+                                           recorder=recorder)
+        self.address = (host or 'localhost', port)
+        self.agent = '%s:%d' % self.address
+        self.node = None
+        self.received = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.receive()
+                error = 'Agent %s closed the connection' % self.agent
+            except (IOError, OSError, ValueError, KeyError,
+                    zlib.error) as e:
+                error = 'Agent %s: %s' % (self.agent, e)
+            if self.stopped.is_set():
+                return
+            self.publish(Snapshot(
+                results=tuple((None, error, 0) for c in self.commands),
+                duration=0,
+                time=monotonic(),
+                timestamp=time.time()))
+            self.stopped.wait(self.poll_delay)
+
+    def receive(self):
+        """ Publish the snapshots of the agent until disconnected """
+        sock = socket.create_connection(self.address, timeout=URL_TIMEOUT)
+        decompressor = zlib.decompressobj()
+        decoder = DeltaDecoder()
+        offset = None
+        buffered = b''
+        try:
+            # Wake up now and then to see if we are stopped
+            sock.settimeout(1)
+            while not self.stopped.is_set():
+                try:
+                    chunk = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if not chunk:
+                    return
+                self.received += len(chunk)
+                buffered += decompressor.decompress(chunk)
+                lines = buffered.split(b'\n')
+                buffered = lines.pop()
+                for line in lines:
+                    record = decoder.decode(json.loads(line.decode('utf-8')))
+                    now = monotonic()
+                    if offset is None:
+                        # The first snapshot may be older than the poll
+                        # delay, the agent sends the latest it has
+                        age = max(time.time() - record['timestamp'], 0)
+                        offset = now - age - record['time']
+                    self.node = record['node']
+                    self.delay = record['delay']
+                    self.publish(Snapshot(
+                        results=record_results(self.commands, record),
+                        duration=record['duration'],
+                        time=min(record['time'] + offset, now),
+                        timestamp=record['timestamp']))
+        finally:
+            sock.close()
+
+
+class FleetPoller(threading.Thread):
+    """
+    Poll many nodes with a bounded pool of worker threads
+
+    Every node has its own Poller, which is not started: a worker calls
+    its poll when it is due. So each node keeps its own snapshots queue,
+    schedule and adaptive delay, while at most workers nodes are polled
+    at the same time.
+    """
+
+    def __init__(self, pollers, workers=FLEET_WORKERS):
+        super(FleetPoller, self).__init__()
+        self.daemon = True
+        self.pollers = pollers
+        self.workers = max(min(workers, len(pollers)), 1)
+        # Next poll per node, None while it is being polled
+        self.next_poll = [0] * len(pollers)
+        self.lock = threading.Lock()
+        self.tasks = Queue()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            now = monotonic()
+            with self.lock:
+                for i, next_poll in enumerate(self.next_poll):
+                    if next_poll is not None and next_poll <= now:
+                        self.next_poll[i] = None
+                        self.tasks.put(i)
+                pending = [t for t in self.next_poll if t is not None]
+            self.wakeup.wait(max(min(pending) - now, 0) if pending
+                             else None)
+
+    def work(self):
+        while True:
+            i = self.tasks.get()
+            if i is None or self.stopped.is_set():
+                return
+            try:
+                next_poll = self.pollers[i].poll()
+            except Exception:
+                next_poll = monotonic() + self.pollers[i].delay
+            with self.lock:
+                self.next_poll[i] = next_poll
+            self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        for i in range(self.workers):
+            self.tasks.put(None)
+        for poller in self.pollers:
+            poller.stop()
 
 
 class IriTop:
 
     global HEADERES
 
-    def __init__(self, args):
-        self.term = Terminal()
+    def __init__(self, args, node=None, term=None):
+        self.node_url = NODE if node is None else node
+        self.term = Terminal() if term is None else term
+        self.screen = Screen(self.term)
         self.prev = {}
         self.poll_delay = args.poll_delay
         self.blink_delay = args.blink_delay
         self.commands = [{'command': 'getNeighbors'},
                          {'command': 'getNodeInfo'}]
+        schedule = args.poll_schedule or {}
+        for command in schedule:
+            if command not in [c['command'] for c in self.commands]:
+                self.commands.append({'command': command})
+        self.intervals = [schedule.get(c['command'], self.poll_delay)
+                          for c in self.commands]
+        self.poll_bounds = args.adaptive_poll
+        self.extra = OrderedDict()
         self.txkeys = [{'keyshort': 'ad', 'sortkey': '1',
                         'header': 'Neighbor Address',
                         'key': 'neighborAddress', 'col': 0,
@@ -299,8 +2080,9 @@ class IriTop:
                        'header': 'Stale tx',
                         'key': 'numberOfStaleTransactions', 'col': 8,
                         'sortcolumn': 'numberOfStaleTransactions'}]
-        self.randSeed = random.randint(0, 100000)
-        self.baseline = dict()
+        # Obscured addresses by address, see showAddress
+        self.obscure_key = urandom(16)
+        self.obscured = dict()
         self.baselineStr = ['Off', 'On']
         self.baselineToggle = 0
         self.obscureAddrToggle = args.obscure_address
@@ -310,256 +2092,860 @@ class IriTop:
         self.oldwidth = 0
         self.incommunicados = 0
         self.localhost = self.set_local_node()
-        self.duration_hist = list()
-        self.duration = 0
-        self.duration_avg = 0
+        # Limit latency history to the last 5 minutes of calls
+        self.latency_window = 60 * 5 / self.poll_delay
+        self.latency = RollingStats(self.latency_window)
+        self.cmd_latency = dict()
         self.sortmode = False
         self.sortcolumn = None
         self.sortorderlist = ["", " "+u"\u25BC", " "+u"\u25B2"]
         self.sortorder = None
+        self.sortthen = []
+        self.sortappend = False
+        self.ordered = (None, None, [])
         self.mss_0 = ""
         self.prev_ms_start = 0
-
-        # Initiate column sort
-        if args.sort:
+        self.node = None
+        self.neighbors = None
+        self.snapshot_time = None
+        self.snapshot_timestamp = None
+        self.error = None
+        self.notice = None
+        self.clock = monotonic
+        self.record_file = args.record
+        self.replay_file = args.replay
+        self.replay_speed = args.speed
+        self.shared_cache = args.shared_cache
+        self.viewer = args.viewer
+        self.counterkeys = [k['key'] for k in self.txkeys[1:]]
+        self.invalid_index = self.counterkeys.index(
+                             'numberOfInvalidTransactions')
+        self.neighbor_map = dict()
+        self.neighbor_ids = itertools.count()
+        self.evict_after = args.evict_after
+        self.max_neighbors = args.max_neighbors
+        self.events = deque(maxlen=EVENT_LOG_SIZE)
+        self.new_events = []
+        self.show_events = False
+        self.series = SeriesStore(len(self.counterkeys),
+                                  RATE_WINDOWS[-1][1],
+                                  max(RATE_RESOLUTION, self.poll_delay))
+        self.tx_rates = []
+        self.tx_ewma = []
+        # Monotonic time of the last getNeighbors response
+        self.neighbors_time = None
+        # Index in COUNTER_VIEWS of the view of the counter columns
+        self.view = 0
+        self.polls = 0
+        self.scroll = 0
+        self.page_size = 1
+        self.blinking = False
+        self.cpu_time = None
+        self.cpu_usage = 0.0
+
+        # Initiate column sort, column 0 leaves the neighbors unsorted
+        sort = args.sort if isinstance(args.sort, list) else [args.sort]
+        if sort[0]:
             try:
-                if args.sort < 0:
+                if sort[0] < 0:
                     self.sortorder = self.sortorderlist[1]
                 else:
                     self.sortorder = self.sortorderlist[2]
-                args.sort = abs(args.sort)
-                self.sortcolumn = self.txkeys[args.sort-1]['sortcolumn']
+                self.sortcolumn = self.txkeys[abs(sort[0])-1]['sortcolumn']
             except IndexError:
                 self.sortcolumn = self.txkeys[0]['sortcolumn']
 
+            # Columns to sort ties by
+            for column in sort[1:]:
+                if column == 0:
+                    continue
+                try:
+                    self.sortthen.append(
+                        (self.txkeys[abs(column)-1]['sortcolumn'],
+                         column > 0))
+                except IndexError:
+                    pass
+
         # Set authentication header if required
         if args.username is not None:
             auth_str = '%s:%s' % (args.username, args.password)
             auth_token = base64.b64encode(auth_str.encode("utf-8"))
             HEADERS['Authorization'] = 'Basic %s' % auth_token.decode()
 
+    local_ips = None
+
     @property
     def get_local_ips(self):
-        return check_output(['/bin/hostname', '--all-ip-addresses']
-                            ).rstrip().split()
+        # Looked up once, a fleet has an IriTop per node
+        if IriTop.local_ips is None:
+            IriTop.local_ips = check_output(['/bin/hostname',
+                                             '--all-ip-addresses']
+                                            ).rstrip().split()
+        return IriTop.local_ips
 
     def set_local_node(self):
         local_ips = ['localhost', '127.0.0.1', '::1']
         local_ips.extend(self.get_local_ips)
-        if urlparse(NODE.lower()).hostname in local_ips:
+        if urlparse(self.node_url.lower()).hostname in local_ips:
             return True
         return False
 
+    def poller(self):
+        """
+        Poller of the node, of the recording to replay, of the
+        snapshots shared with other instances or streamed by an agent
+        """
+        recorder = None
+        if self.record_file is not None:
+            recorder = Recorder(self.record_file)
+        kw = dict(fetch=partial(fetch_concurrent, node=self.node_url),
+                  recorder=recorder, intervals=self.intervals,
+                  bounds=self.poll_bounds)
+        if self.replay_file is not None:
+            poller = ReplayPoller(self.commands, self.poll_delay,
+                                  self.replay_file, self.replay_speed,
+                                  recorder=recorder)
+        elif self.viewer is not None:
+            poller = ViewerPoller(self.commands, self.poll_delay,
+                                  *self.viewer, recorder=recorder)
+        elif self.shared_cache is not None:
+            poller = SharedPoller(self.commands, self.poll_delay,
+                                  self.shared_cache or
+                                  shared_cache_file(self.node_url),
+                                  self.node_url, **kw)
+        else:
+            poller = Poller(self.commands, self.poll_delay, **kw)
+        self.clock = poller.clock
+        return poller
+
     def run(self, stdscr):
 
         stdscr.clear()
-        node = None
-
-        print("IRITop connecting to node %s..." % self.showAddress(NODE))
-
-        with self.term.hidden_cursor():
-            val = ""
-            tlast = 0
-            self.hist = {}
 
-            while val.lower() != 'q':
+        print("IRITop connecting to node %s..." %
+              self.showAddress(self.node_url))
 
-                random.seed(self.randSeed)
+        self.screen.sync = sync_update_supported(self.term)
 
-                val = self.term.inkey(timeout=self.blink_delay)
+        poller = self.poller()
+        poller.start()
 
-                # Sort mode detection
-                if val.lower() == 's':
-                    if self.sortmode is False:
-                        self.sortmode = True
-                    else:
-                        self.sortmode = False
-                if self.sortmode:
-                    if self.sortorder is None:
-                        self.sortorder = self.sortorderlist[2]
-                    keylist = []
+        try:
+            with self.term.hidden_cursor():
+                self.loop(poller)
+        finally:
+            poller.stop()
+
+    def process(self, poller):
+        """ Process the snapshots published since the last call """
+        snapshots = poller.drain()
+        for snapshot in snapshots:
+            try:
+                self.update(snapshot)
+                self.error = None
+            except Exception as e:
+                # Keep showing the last data along with the error
+                self.error = ('%s' % e).strip()
+        return snapshots
+
+    def loop(self, poller, tick=None):
+        """
+        Show the node until Q is pressed, calling tick (if set) on every
+        turn, e.g. to keep up with other nodes in the meantime
+        """
+        val = ""
+        # Draw right away, also when coming back to the loop
+        redraw = True
+        self.screen.invalidate()
+        if self.snapshot_time is None:
+            # Clear what was on screen before, e.g. the fleet
+            self.height, self.width = self.term.height, self.term.width
+            self.draw_waiting()
+            redraw = False
+
+        while val.lower() != 'q':
+
+            val = self.term.inkey(timeout=self.blink_delay)
+            if tick is not None:
+                tick()
+
+            # Sort mode detection
+            if val.lower() == 's':
+                if self.sortmode is False:
+                    self.sortmode = True
+                else:
+                    self.sortmode = False
+                self.sortappend = False
+            if self.sortmode:
+                if self.sortorder is None:
+                    self.sortorder = self.sortorderlist[2]
+                keylist = []
+                for k in self.txkeys:
+                    keylist.append(k['sortkey'])
+                key = val.lower()
+                if key == '+':
+                    self.sortappend = True
+                elif key in keylist and self.sortappend:
+                    self.sortThen(key)
+                    self.sortmode = False
+                    self.sortappend = False
+                elif key in keylist:
+                    self.sortthen = []
                     for k in self.txkeys:
-                        keylist.append(k['sortkey'])
-                    key = val.lower()
-                    if key in keylist:
-                        for k in self.txkeys:
-                            if key == k['sortkey']:
-                                # Toggle sort direction
-                                if self.sortcolumn == k['sortcolumn']:
-                                    if self.sortorder == self.sortorderlist[2]:
-                                        self.sortorder = self.sortorderlist[1]
-                                    else:
-                                        self.sortorder = self.sortorderlist[2]
+                        if key == k['sortkey']:
+                            # Toggle sort direction
+                            if self.sortcolumn == k['sortcolumn']:
+                                if self.sortorder == self.sortorderlist[2]:
+                                    self.sortorder = self.sortorderlist[1]
                                 else:
                                     self.sortorder = self.sortorderlist[2]
-                                # Set sort column
-                                self.sortcolumn = k['sortcolumn']
-                                self.sortmode = False
-
-                self.oldheight, self.oldwidth = self.height, self.width
-                self.height, self.width = self.term.height, self.term.width
-
-                if int(time.time()) - tlast > self.poll_delay:
-
-                    if node:
-                        self.prev_ms_start = node["milestoneStartIndex"]
-
-                    startTime = int(round(time.time() * 1000))
-                    results = [fetch_data(self.commands[i]) for i
-                               in range(len(self.commands))]
-                    endTime = int(round(time.time() * 1000))
-                    self.logDuration(endTime - startTime)
-
-                    neighbors = None
-                    node = None
-                    for data, e in results:
-                        if e is not None:
-                            raise Exception("Error fetching data from node:"
-                                            " %s\n" % e)
-                        if 'appName' in data.keys():
-                            node = data
-                        elif 'neighbors' in data.keys():
-                            neighbors = data['neighbors']
-
-                    tlast = int(time.time())
-
-                    for neighbor in neighbors:
-                        for txkey in self.txkeys[1:]:
-                            if txkey['key'] not in neighbor:
-                                neighbor[txkey['key']] = 0
-                                neighbor[txkey['keyshort']] = 0
-                                neighbor['%sDelta' % txkey['key']] = 0
-
-                    # Keep history of tx
-                    tx_history = {}
-                    for neighbor in neighbors:
-                        for txkey in self.txkeys[1:]:
-                            self.historizer(txkey['keyshort'],
-                                            txkey['key'],
-                                            tx_history,
-                                            neighbor)
-                    self.hist = tx_history
-
-                if val.lower() == 'o':
-                    self.obscureAddrToggle = self.obscureAddrToggle ^ 1
-
-                if val.lower() == 'b':
-                    for neighbor in neighbors:
-                        for txkey in self.txkeys[1:]:
-                            self.baseline[self.getBaselineKey(neighbor,
-                                          txkey['keyshort'])] = \
-                                          neighbor[txkey['key']]
-                    self.baselineToggle = self.baselineToggle ^ 1
-
-                if ((self.oldheight != self.height) or
-                        (self.oldwidth != self.width)):
-                            print(self.term.clear)
-
-                print(self.term.move(0, 0) + self.term.black_on_cyan(
-                      "IRITop - Simple IOTA IRI Node Monitor (%s)"
-                      .ljust(self.width) % __VERSION__))
-
-                for neighbor in neighbors:
-                    for txkey in self.txkeys[1:]:
-                        key = self.getBaselineKey(neighbor, txkey['keyshort'])
-                        if key not in self.baseline:
-                            self.baseline[key] = 0
-
-                self.show(1, 0, "App Name", node, "appName")
-                self.show(2, 0, "App Version", node, "appVersion")
-
-                s = self.term.cyan("Free: ") + \
-                    str(node["jreFreeMemory"]//MB) + \
-                    " Mb  " + \
-                    self.term.cyan("Max: ") + \
-                    str(node["jreMaxMemory"]//MB) + \
-                    " Mb " + \
-                    self.term.cyan("Total: ") + \
-                    str(node["jreTotalMemory"]//MB) + " Mb   "
-                self.show_string(1, 1, "JRE Memory", s)
-
-                self.show_histogram(2, 1, "JRE Memory",
-                                    node["jreTotalMemory"] -
-                                    node["jreFreeMemory"],
-                                    node["jreMaxMemory"],
-                                    0.8,
-                                    span=2)
-
-                ms_start = node["milestoneStartIndex"]
-                delta_ms_start = self.prev_ms_start - ms_start
-                self.mss_1 = self.mss_0
-                self.mss_0 = ("%s" % ms_start) + ("" if delta_ms_start == 0
-                                                  else " (%d)" %
-                                                  delta_ms_start)
-                self.show_string(3, 2, "", " "*16)
-                self.show_string(3, 2, "Milestone Start", self.mss_0,
-                                 prev=self.mss_1)
-
-                self.show(4, 2, "Milestone Index", node,
-                          "latestMilestoneIndex")
-                self.show(5, 2, "Milestone Solid", node,
-                          "latestSolidSubtangleMilestoneIndex")
-
-                self.show(3, 0, "JRE Version", node, "jreVersion")
-                self.show(4, 1, "Tips", node, "tips")
-                self.show(3, 1, "Tx To Request", node,
-                          "transactionsToRequest")
-
-                self.show_string(6, 0, "Node Address", self.showAddress(NODE))
-
-                self.show_string(4, 0, "Baseline",
-                                 self.baselineStr[self.baselineToggle])
-                self.show_string(5, 0, "Response Time", str(self.duration) +
-                                       " ms " + self.term.cyan("Avg: ") +
-                                       str(self.duration_avg) + " ms   ")
-                neighborCount = "%s" % node['neighbors']
-                if self.incommunicados > 0:
-                    neighborCount += self.term.red(" / %d " %
-                                                   self.incommunicados)
-                else:
-                    neighborCount += "    "
-                self.show_string(6, 2, "Neighbors", neighborCount)
+                            else:
+                                self.sortorder = self.sortorderlist[2]
+                            # Set sort column
+                            self.sortcolumn = k['sortcolumn']
+                            self.sortmode = False
+
+            # Neighbor table scrolling
+            if val.code == self.term.KEY_UP:
+                self.scroll -= 1
+            elif val.code == self.term.KEY_DOWN:
+                self.scroll += 1
+            elif val.code == self.term.KEY_PGUP:
+                self.scroll -= self.page_size
+            elif val.code == self.term.KEY_PGDOWN:
+                self.scroll += self.page_size
+            elif val.code == self.term.KEY_HOME:
+                self.scroll = 0
+            elif val.code == self.term.KEY_END:
+                self.scroll = sys.maxsize
+
+            self.oldheight, self.oldwidth = self.height, self.width
+            self.height, self.width = self.term.height, self.term.width
+
+            snapshots = self.process(poller)
+
+            # Nothing to show until the first poll completed
+            if self.snapshot_time is None:
+                if ((self.oldheight, self.oldwidth) !=
+                        (self.height, self.width)):
+                    self.screen.invalidate()
+                    redraw = True
+                if redraw or snapshots:
+                    redraw = False
+                    self.draw_waiting()
+                continue
 
-                if self.localhost:
-                    self.show_string(5, 1, "Load Average", getloadavg())
-                else:
-                    self.show_string(5, 1, "Load Average", 'N/A')
+            # Only redraw when something can have changed on screen
+            if not (redraw or val or snapshots or self.blinking or
+                    self.height != self.oldheight or
+                    self.width != self.oldwidth or
+                    self.lagging(poller)):
+                continue
 
-                self.show_neighbors(7, neighbors)
+            redraw = False
+            self.blinking = False
+            self.logCpuUsage()
 
-    def logDuration(self, duration):
-        self.duration = duration
-        self.duration_hist.append(duration)
-        self.duration_avg = int(sum(self.duration_hist) /
-                                len(self.duration_hist))
-        # Limit history to the last 5 minutes of calls
-        if len(self.duration_hist) > (60*5/self.poll_delay):
-            del self.duration_hist[0]
+            if val.lower() == 'o':
+                self.obscureAddrToggle = self.obscureAddrToggle ^ 1
 
-    def showAddress(self, address):
-        if self.obscureAddrToggle == 1:
-            return scrambleAddress(address)
-        return address
+            if val.lower() == 'e':
+                self.show_events = not self.show_events
+
+            if val.lower() == 'v':
+                self.view = (self.view + 1) % len(COUNTER_VIEWS)
+
+            if val.lower() == 'b':
+                for neighbor in self.neighbors:
+                    neighbor.baseline[:] = neighbor.counters
+                self.baselineToggle = self.baselineToggle ^ 1
+
+            if ((self.oldheight != self.height) or
+                    (self.oldwidth != self.width)):
+                self.screen.invalidate()
+
+            self.draw(poller)
+
+    def draw_waiting(self):
+        """ Draw the frame shown until the first poll completed """
+        self.screen.write(0, 0, self.term.black_on_cyan(
+                          "IRITop - Simple IOTA IRI Node Monitor (%s)"
+                          .ljust(self.width) % __VERSION__))
+        if self.error is None:
+            self.screen.write(2, 0, ("Connecting to %s..." %
+                                     self.showAddress(self.node_url))
+                              .ljust(self.width)[:self.width])
+        else:
+            self.screen.write(2, 0, self.term.red(
+                self.error.ljust(self.width)[:self.width]))
+        self.screen.flush()
+
+    def draw(self, poller):
+        """ Draw a frame of the last snapshot """
+        node, neighbors = self.node, self.neighbors
+
+        self.screen.write(0, 0, self.term.black_on_cyan(
+                          "IRITop - Simple IOTA IRI Node Monitor (%s)"
+                          .ljust(self.width) % __VERSION__))
+
+        self.show(1, 0, "App Name", node, "appName")
+        self.show(2, 0, "App Version", node, "appVersion")
+
+        s = self.term.cyan("Free: ") + \
+            str(node["jreFreeMemory"]//MB) + \
+            " Mb  " + \
+            self.term.cyan("Max: ") + \
+            str(node["jreMaxMemory"]//MB) + \
+            " Mb " + \
+            self.term.cyan("Total: ") + \
+            str(node["jreTotalMemory"]//MB) + " Mb   "
+        self.show_string(1, 1, "JRE Memory", s)
+
+        self.show_histogram(2, 1, "JRE Memory",
+                            node["jreTotalMemory"] -
+                            node["jreFreeMemory"],
+                            node["jreMaxMemory"],
+                            0.8,
+                            span=2)
+
+        ms_start = node["milestoneStartIndex"]
+        delta_ms_start = self.prev_ms_start - ms_start
+        self.mss_1 = self.mss_0
+        self.mss_0 = ("%s" % ms_start) + ("" if delta_ms_start == 0
+                                          else " (%d)" %
+                                          delta_ms_start)
+        self.show_string(3, 2, "", " "*16)
+        self.show_string(3, 2, "Milestone Start", self.mss_0,
+                         prev=self.mss_1)
+
+        self.show(4, 2, "Milestone Index", node,
+                  "latestMilestoneIndex")
+        self.show(5, 2, "Milestone Solid", node,
+                  "latestSolidSubtangleMilestoneIndex")
+
+        self.show(3, 0, "JRE Version", node, "jreVersion")
+        self.show(4, 1, "Tips", node, "tips")
+        self.show(3, 1, "Tx To Request", node,
+                  "transactionsToRequest")
+
+        address = self.node_url
+        if poller.role == 'viewer' and poller.node is not None:
+            address = poller.node
+        self.show_string(6, 0, "Node Address", self.showAddress(address))
+
+        self.show_string(4, 0, "Baseline",
+                         self.baselineStr[self.baselineToggle])
+        self.show_string(5, 0, "Response Time", str(self.latency.last) +
+                               " ms " + self.term.cyan("Avg: ") +
+                               str(self.latency.mean) + " ms   ")
+        neighborCount = "%s" % node['neighbors']
+        if self.incommunicados > 0:
+            neighborCount += self.term.red(" / %d " %
+                                           self.incommunicados)
+        else:
+            neighborCount += "    "
+        neighborCount += self.term.cyan("Kept: ") + "%d %.1f MB" % (
+                         len(self.neighbor_map), self.state_size() / MB)
+        self.show_string(6, 2, "Neighbors", neighborCount)
 
-    def getBaselineKey(self, neighbor, subkey):
-        return "%s:%s" % (neighbor['address'], subkey)
+        if self.localhost:
+            self.show_string(5, 1, "Load Average", getloadavg())
+        else:
+            self.show_string(5, 1, "Load Average", 'N/A')
+
+        client = get_client(self.node_url)
+        self.show_string(6, 1, "Connections",
+                         "%d " % client.connections +
+                         self.term.cyan("Reused: ") +
+                         "%d " % client.reused +
+                         self.term.cyan("Hs: ") +
+                         "%d ms  " % client.handshake_avg)
+
+        # Latency of extra commands is in the headless records
+        for i, command in enumerate(self.commands[:2]):
+            stats = self.cmd_latency[command['command']]
+            self.show_string(7, i, command['command'],
+                             "%d" % stats.percentile(50) +
+                             self.term.cyan(" p95 ") +
+                             "%d" % stats.percentile(95) +
+                             self.term.cyan(" p99 ") +
+                             "%d" % stats.percentile(99) +
+                             self.term.cyan(" max ") +
+                             "%d ms   " % stats.max)
+
+        self.showSnapshotAge(7, 2, poller)
+        if poller.role == 'viewer':
+            self.show_string(8, 2, "Received", "%.1f kB" %
+                             (poller.received / 1024) +
+                             self.term.cyan(" from ") + poller.agent + "   ")
+        else:
+            self.showCircuit(8, 2)
+
+        # Smoothed rates along with the per second view of the neighbors
+        per_second = COUNTER_VIEWS[self.view][0] == 'per-second'
+        self.show_string(8, 0, "All tx/s",
+                         (self.term.cyan("ewma ") if per_second else "") +
+                         " ".join(self.term.cyan(label + ": ") +
+                                  ("-" if rate is None
+                                   else "%.1f" % rate)
+                                  for label, rate in (self.tx_ewma
+                                                      if per_second
+                                                      else self.tx_rates)) +
+                         "   ")
+
+        s = "%.1f s" % poller.delay
+        if poller.bounds is not None:
+            s += self.term.cyan(" adaptive %g-%g s" % poller.bounds)
+        if poller.role == 'viewer':
+            s += self.term.cyan(" agent")
+        elif poller.role is not None:
+            s += self.term.cyan(" shared ") + poller.role
+        self.show_string(8, 1, "Poll Delay", s + "   ")
+
+        bottom = self.height - 2
+        if self.show_events:
+            bottom = self.show_event_log(bottom)
+        self.notice = poller.notice
+        self.show_neighbors(9, neighbors, bottom)
+
+        self.screen.flush()
+
+    def run_headless(self, output='-', exporter=None, agent=None):
+        """
+        Write a JSON record per poll to output (if set), publish
+        metrics to exporter (if set) and snapshots to agent (if set)
+        instead of drawing the screen
+        """
+        if output is None:
+            stream = None
+        elif output == '-':
+            stream = sys.stdout
+        else:
+            stream = open(output, 'a')
+
+        poller = self.poller()
+        poller.start()
 
-    def historizer(self, txtype, wsid, hd, n):
-        nid = "%s-%s" % (n['address'], txtype)
-        nidd = "%s-%sd" % (n['address'], txtype)
-        c = n[wsid]
         try:
-            p = self.hist[nid]
-            hd[nid] = c
-            if p > 0:
-                hd[nidd] = c - p
+            while True:
+                if poller.notice != self.notice:
+                    self.notice = poller.notice
+                    sys.stderr.write("%s\n" % self.notice)
+                try:
+                    snapshot = poller.snapshots.get(timeout=1)
+                except Empty:
+                    if not poller.is_alive():
+                        # Replay is over
+                        break
+                    continue
+
+                if agent is not None:
+                    agent.publish(self.commands, snapshot, poller.delay)
+
+                try:
+                    self.update(snapshot)
+                    record = self.record(snapshot)
+                    up = True
+                except Exception as e:
+                    record = {'time': round(snapshot.timestamp, 3),
+                              'error': ('%s' % e).strip()}
+                    up = False
+
+                if exporter is not None:
+                    exporter.publish(self.metrics(up))
+
+                if stream is not None:
+                    stream.write(json.dumps(record, separators=(',', ':')) +
+                                 '\n')
+                    stream.flush()
+        except KeyboardInterrupt:
+            pass
+        except IOError as e:
+            # Reader of the output went away
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            poller.stop()
+            if agent is not None:
+                agent.stop()
+            if stream not in (None, sys.stdout):
+                stream.close()
+
+    def record(self, snapshot):
+        """ Return the data of the last processed snapshot as a dict """
+        node = dict((field, self.node[field]) for field
+                    in NODE_RECORD + NODE_SERIES if field in self.node)
+
+        latency = dict((command, stats.last) for command, stats
+                       in self.cmd_latency.items())
+        latency['poll'] = self.latency.last
+
+        neighbors = []
+        for neighbor in self.neighbors:
+            n = {'address': self.showAddress(neighbor.address),
+                 'connectionType': neighbor.connection_type,
+                 'incommunicado': neighbor.incommunicado}
+            for i, key in enumerate(self.counterkeys):
+                n[key] = neighbor.counters[i]
+                n['%sDelta' % key] = neighbor.deltas[i]
+            neighbors.append(n)
+
+        return {'time': round(snapshot.timestamp, 3),
+                'node': node,
+                'latency': latency,
+                'incommunicados': self.incommunicados,
+                'txRates': dict((label, None if rate is None
+                                 else round(rate, 3))
+                                for label, rate in self.tx_rates),
+                'extra': self.extra,
+                'events': [{'event': event.kind,
+                            'address': self.showAddress(event.address,
+                                                        cache=False),
+                            'connectionType': event.connection_type}
+                           for event in self.new_events],
+                'neighbors': neighbors}
+
+    def metrics(self, up=True):
+        """ Return the last processed snapshot in Prometheus text format """
+        lines = []
+        node_label = ('node', self.showAddress(self.node_url))
+
+        def metric(name, metric_type, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                lines.append('%s{%s} %s' % (name, metric_labels(labels),
+                                            repr(float(value))))
+
+        metric('iritop_up', 'gauge', 'Whether the last poll succeeded',
+               [([node_label], 1 if up else 0)])
+
+        # Only up until all commands succeeded once, e.g. the first poll
+        # can fetch getNodeInfo but not getNeighbors
+        if self.snapshot_time is None:
+            return '\n'.join(lines) + '\n'
+
+        metric('iritop_last_poll_timestamp_seconds', 'gauge',
+               'Time of the last successful poll',
+               [([node_label], self.snapshot_timestamp)])
+        metric('iritop_poll_duration_milliseconds', 'gauge',
+               'Duration of the last poll',
+               [([node_label], self.latency.last)])
+        # Quantiles over the rolling window only: it has no cumulative
+        # sum and count
+        metric('iritop_command_duration_seconds', 'summary',
+               'Duration quantiles of node API commands',
+               [([node_label, ('command', command),
+                  ('quantile', '%g' % (p / 100.0))],
+                 stats.percentile(p) / 1000)
+                for command, stats in sorted(self.cmd_latency.items())
+                for p in (50, 95, 99, 100)])
+
+        metric('iri_info', 'gauge', 'Node software versions',
+               [([node_label] + [(metric_name(field),
+                                  self.node.get(field, ''))
+                                 for field in NODE_RECORD], 1)])
+        for field, name, help in EXPORTER_NODE_METRICS:
+            if field in self.node:
+                metric(name, 'gauge', help,
+                       [([node_label], self.node[field])])
+
+        if self.neighbors is None:
+            return '\n'.join(lines) + '\n'
+
+        neighbor_labels = [[node_label,
+                            ('neighbor', self.showAddress(n.address)),
+                            ('connection_type', n.connection_type)]
+                           for n in self.neighbors]
+        for i, txkey in enumerate(self.txkeys[1:]):
+            metric('iri_neighbor_%s_total' % metric_name(txkey['key']),
+                   'counter', '%s of the neighbor' % txkey['header'],
+                   [(labels, n.counters[i]) for labels, n
+                    in zip(neighbor_labels, self.neighbors)])
+        metric('iri_neighbor_incommunicado', 'gauge',
+               'Whether the neighbor sent no transactions since last poll',
+               [(labels, 1 if n.incommunicado else 0) for labels, n
+                in zip(neighbor_labels, self.neighbors)])
+
+        return '\n'.join(lines) + '\n'
+
+    def update(self, snapshot):
+        """
+        Process a snapshot published by the poller
+
+        Commands that were not polled (None) or failed keep their
+        previous data. Failures are raised after the other commands
+        were processed.
+        """
+        self.logDuration(snapshot.duration)
+
+        neighbors = None
+        node = None
+        errors = []
+        self.new_events = []
+        for command, result in zip(self.commands, snapshot.results):
+            if result is None:
+                continue
+            data, e, duration = result
+            if e is not None:
+                if '%s' % e not in errors:
+                    errors.append('%s' % e)
+                continue
+            self.logDuration(duration, command['command'])
+            if command['command'] == 'getNodeInfo':
+                node = data
+            elif command['command'] == 'getNeighbors':
+                neighbors = data['neighbors']
+                # Commands are fetched concurrently, the response came
+                # in the poll duration after it started
+                response_time = snapshot.time - max(
+                    snapshot.duration - duration, 0) / 1000.0
             else:
-                hd[nidd] = 0
-        except KeyError:
-            hd[nid] = 0
-            hd[nidd] = 0
+                self.extra[command['command']] = data
+
+        if node is not None:
+            if self.node:
+                self.prev_ms_start = self.node["milestoneStartIndex"]
+            self.node = node
+
+        if neighbors is not None:
+            # Keep history of tx
+            self.polls += 1
+            # Time since the previous response, and the weight of rates
+            # over that time in each smoothed rate
+            dt = 0
+            if self.neighbors_time is not None:
+                dt = response_time - self.neighbors_time
+            self.neighbors_time = response_time
+            alphas = [1 - math.exp(-max(dt, 0) / seconds)
+                      for label, seconds in EWMA_WINDOWS]
+            neighbors = [self.historizer(neighbor, dt, alphas)
+                         for neighbor in neighbors]
+            self.evict(len(neighbors))
+
+            # Flag neighbors that are incommunicado, a neighbor that
+            # just joined has no deltas yet. Log the changes since the
+            # last poll, but not the neighbors of the first one.
+            previous = self.neighbors
+            events = []
+            self.incommunicados = 0
+            for neighbor in neighbors:
+                was = neighbor.incommunicado
+                neighbor.incommunicado = (neighbor.deltas[0] == 0 and
+                                          neighbor.joined != self.polls and
+                                          self.polls > INCOMMUNICADO_POLLS)
+                if neighbor.incommunicado:
+                    self.incommunicados += 1
+
+                if previous is None:
+                    continue
+                if neighbor.joined == self.polls:
+                    kind = 'joined'
+                elif neighbor.reset:
+                    kind = 'reset'
+                elif neighbor.incommunicado != was:
+                    kind = ('incommunicado' if neighbor.incommunicado
+                            else 'communicating')
+                else:
+                    continue
+                events.append(Event(snapshot.timestamp, kind,
+                                    neighbor.address,
+                                    neighbor.connection_type))
+
+            if previous is not None:
+                present = set(neighbor.address for neighbor in neighbors)
+                for neighbor in previous:
+                    if neighbor.address not in present:
+                        events.append(Event(snapshot.timestamp, 'left',
+                                            neighbor.address,
+                                            neighbor.connection_type))
+                        # Forget its obscured address
+                        self.obscured.pop(neighbor.address, None)
+
+            self.events.extend(events)
+            self.new_events = events
+            self.neighbors = neighbors
+
+            # Smoothed rate of all transactions over all neighbors
+            self.tx_ewma = []
+            for j, (label, seconds) in enumerate(EWMA_WINDOWS):
+                rates = [neighbor.ewma[j][0] for neighbor in neighbors
+                         if neighbor.ewma[j][0] == neighbor.ewma[j][0]]
+                self.tx_ewma.append((label, sum(rates) if rates else None))
+
+        fresh = node is not None or neighbors is not None
+        if fresh and self.node is not None and self.neighbors is not None:
+            self.snapshot_time = snapshot.time
+            self.snapshot_timestamp = snapshot.timestamp
+
+            # Windowed rates of all transactions over all neighbors,
+            # sampled when the counters are fresh
+            if neighbors is not None:
+                self.series.sample(snapshot.time, neighbors)
+                self.tx_rates = [(label, self.series.total_rate(seconds))
+                                 for label, seconds in RATE_WINDOWS]
+
+        if errors:
+            raise Exception("Error fetching data from node: %s" %
+                            "; ".join(errors))
+
+    def evict(self, present):
+        """
+        Forget neighbors absent for more than evict_after polls, and
+        the ones absent longest while more than max_neighbors are kept.
+        Neighbors of the last poll (present of them) are always kept.
+        """
+        if len(self.neighbor_map) <= present:
+            return
+        absent = sorted((neighbor for neighbor in self.neighbor_map.values()
+                         if neighbor.polled != self.polls),
+                        key=lambda neighbor: neighbor.polled)
+        excess = len(self.neighbor_map) - self.max_neighbors
+        for i, neighbor in enumerate(absent):
+            if i >= excess and self.polls - neighbor.polled <= \
+                    self.evict_after:
+                break
+            del self.neighbor_map[neighbor.address]
+
+    def state_size(self):
+        """ Approximate bytes kept for neighbors, history included """
+        size = self.series.nbytes
+        neighbor = next(iter(self.neighbor_map.values()), None)
+        if neighbor is not None:
+            # Neighbors only differ by the length of their address
+            size += len(self.neighbor_map) * (
+                    sys.getsizeof(neighbor) +
+                    sys.getsizeof(neighbor.address) +
+                    sum(sys.getsizeof(a) for a in
+                        [neighbor.counters, neighbor.deltas,
+                         neighbor.baseline, neighbor.rates] + neighbor.ewma))
+        return size
+
+    def sortThen(self, sortkey):
+        """ Add a column to sort ties by, or reverse it if present """
+        for k in self.txkeys:
+            if k['sortkey'] != sortkey or k['sortcolumn'] == self.sortcolumn:
+                continue
+            for i, (column, reverse) in enumerate(self.sortthen):
+                if column == k['sortcolumn']:
+                    self.sortthen[i] = (column, not reverse)
+                    break
+            else:
+                self.sortthen.append((k['sortcolumn'], True))
+
+    def sortKey(self, column):
+        """ Return the key function to sort neighbors by column """
+        if column not in self.counterkeys:
+            return lambda n: n.address
+        i = self.counterkeys.index(column)
+        return lambda n: n.counters[i]
 
-        n["%sDelta" % wsid] = hd[nidd]
+    def sortKeys(self):
+        """ Return (column, reverse) of all sort columns, primary first """
+        if self.sortcolumn is None:
+            return ()
+        revso = self.sortorder == self.sortorderlist[2]
+        return ((self.sortcolumn, revso),) + tuple(self.sortthen)
+
+    def orderedNeighbors(self, neighbors):
+        """
+        Return the neighbors in sort order
+
+        The order is only computed again when a new snapshot arrived or
+        the sort columns changed, not on every redraw.
+        """
+        sortkeys = self.sortKeys()
+        if self.ordered[0] is neighbors and self.ordered[1] == sortkeys:
+            return self.ordered[2]
+
+        ordered_neighbors = list(neighbors)
+        # Stable sorts, least significant column first
+        for column, reverse in reversed(sortkeys):
+            ordered_neighbors.sort(key=self.sortKey(column), reverse=reverse)
+
+        self.ordered = (neighbors, sortkeys, ordered_neighbors)
+        return ordered_neighbors
+
+    def lagging(self, poller):
+        """ Data is older than expected, keep the snapshot age ticking """
+        return self.clock() - self.snapshot_time > 2 * poller.delay
+
+    def logCpuUsage(self):
+        """ Log CPU used by this process since the previous call """
+        now = monotonic()
+        cpu = sum(times()[:2])
+        if self.cpu_time is not None and now > self.cpu_time[0]:
+            self.cpu_usage = (100.0 * (cpu - self.cpu_time[1]) /
+                              (now - self.cpu_time[0]))
+        self.cpu_time = (now, cpu)
+
+    def showSnapshotAge(self, row, col, poller):
+        """ Show how old the data on screen is, highlight if lagging """
+        s = "%.1f s" % (self.clock() - self.snapshot_time)
+        if self.lagging(poller):
+            s = self.term.red(s)
+        if poller.polling_since is not None:
+            s += self.term.cyan(" polling")
+        self.show_string(row, col, "Snapshot Age", s + "   ")
+
+    def showCircuit(self, row, col):
+        """ Show the circuit breaker state of the node and alternates """
+        client = get_client(self.node_url)
+        state = client.state
+        if state == 'open':
+            s = self.term.red("open %d s" % (client.open_until - monotonic()))
+        elif state == 'half-open':
+            s = self.term.yellow(state)
+        else:
+            s = state
+        if ALTERNATES and self.node_url == NODE:
+            s += self.term.cyan(" Alternates: ") + "%d/%d up" % (
+                 len([node for node in ALTERNATES
+                      if get_client(node).state != 'open']),
+                 len(ALTERNATES))
+        self.show_string(row, col, "Circuit", s + "   ")
+
+    def logDuration(self, duration, command=None):
+        """
+        Log the duration of a poll, or of a single command
+        if command is set
+        """
+        if command is None:
+            self.latency.add(duration)
+        else:
+            if command not in self.cmd_latency:
+                self.cmd_latency[command] = RollingStats(self.latency_window)
+            self.cmd_latency[command].add(duration)
+
+    def showAddress(self, address, cache=True):
+        """
+        Address to show, obscured if toggled. Obscured addresses are
+        cached until the neighbor leaves, unless cache is False (e.g.
+        for neighbors that left).
+        """
+        if self.obscureAddrToggle == 1:
+            obscured = self.obscured.get(address)
+            if obscured is None:
+                obscured = scrambleAddress(address, self.obscure_key)
+                if cache:
+                    self.obscured[address] = obscured
+            return obscured
+        return address
+
+    def historizer(self, data, dt=0, alphas=()):
+        """
+        Return the neighbor of getNeighbors data, with updated deltas,
+        and rates over dt seconds, see Neighbor.update
+        """
+        neighbor = self.neighbor_map.get(data['address'])
+        if neighbor is None:
+            neighbor = Neighbor(next(self.neighbor_ids),
+                                data['address'],
+                                data.get('connectionType', ''),
+                                len(self.counterkeys))
+            self.neighbor_map[data['address']] = neighbor
+        neighbor.update(data, self.counterkeys, self.polls, dt, alphas)
+        return neighbor
 
     def show(self, row, col, label, dictionary, value):
 
@@ -587,9 +2973,10 @@ class IriTop:
 
         if value in self.prev and dictionary[value] != self.prev[value]:
             vs = self.term.on_blue(vs)
+            self.blinking = True
 
-        print(self.term.move(row, x1) + self.term.cyan(label + ":"))
-        print(self.term.move(row, x2) + vs + "  ")
+        self.screen.write(row, x1, self.term.cyan(label + ":"))
+        self.screen.write(row, x2, vs + "  ")
 
         self.prev[value] = dictionary[value]
 
@@ -601,10 +2988,10 @@ class IriTop:
         value = str(value)
         if prev != "" and value != prev:
             value = self.term.on_blue(value)
+            self.blinking = True
 
-        print(self.term.move(row, x1) + self.term.cyan(label + ":"))
-        print(self.term.move(row, x2) +
-              self.term.bright_cyan(str(value) + "  "))
+        self.screen.write(row, x1, self.term.cyan(label + ":"))
+        self.screen.write(row, x2, self.term.bright_cyan(str(value) + "  "))
 
     def show_histogram(self, row, col, label, value, value_max,
                        warning_limit=0.8, span=1):
@@ -632,17 +3019,17 @@ class IriTop:
             mY = mG
             mG = 0
 
-        print(self.term.move(row, x1) + self.term.cyan(label + ":"))
-        print(self.term.move(row, x2)
-              + self.term.white("[")
-              + self.term.green("|" * mG)
-              + self.term.yellow("|" * mY)
-              + self.term.red("#" * mR)
-              + self.term.bright_black("-" * mB)
-              + self.term.white("]"))
-
-    def show_neighbors(self, row, neighbors):
-        global ITER
+        self.screen.write(row, x1, self.term.cyan(label + ":"))
+        self.screen.write(row, x2,
+                          self.term.white("[")
+                          + self.term.green("|" * mG)
+                          + self.term.yellow("|" * mY)
+                          + self.term.red("#" * mR)
+                          + self.term.bright_black("-" * mB)
+                          + self.term.white("]"))
+
+    def show_neighbors(self, row, neighbors, bottom):
+        """ Show the neighbor table from row down to above row bottom """
         cols = 9
         height, width = self.term.height, self.term.width
         cw = width // cols
@@ -651,122 +3038,362 @@ class IriTop:
         for c in range(cols - 1):
             cwl.append(cw1 + (c * cw))
 
-        self.incommunicados = 0
         revso = True if self.sortorder == self.sortorderlist[2] else False
+        sortthen = dict(self.sortthen)
+        sortpos = dict((column, i + 2) for i, (column, reverse)
+                       in enumerate(self.sortthen))
 
+        view = COUNTER_VIEWS[self.view][1]
         for k in self.txkeys:
-            ch = k['header'] + (' [%s]' % k['sortkey'] if self.sortmode
-                                else (self.sortorderlist[1] if revso
-                                      else self.sortorderlist[2])
-                                if self.sortcolumn == k['sortcolumn']
-                                else '')
+            header = k['header']
+            if k['keyshort'] == 'ad' and view:
+                header += " [%s]" % view
+            ch = header + (' [%s]' % k['sortkey'] if self.sortmode
+                           else (self.sortorderlist[1] if revso
+                                 else self.sortorderlist[2])
+                           if self.sortcolumn == k['sortcolumn']
+                           else (self.sortorderlist[1]
+                                 if sortthen[k['sortcolumn']]
+                                 else self.sortorderlist[2]) +
+                           "%d" % sortpos[k['sortcolumn']]
+                           if k['sortcolumn'] in sortthen
+                           else '')
             ch += "" if k['keyshort'] != 'ad' else " "*(cw*4-len(ch))
-            print(self.term.move(row, cwl[k['col']]) +
-                  self.term.black_on_green(ch.rjust(cw)))
+            self.screen.write(row, cwl[k['col']],
+                              self.term.black_on_green(ch.rjust(cw)))
 
         row += 1
 
         # Sort neighbors
-        ordered_neighbors = []
         if self.sortcolumn is None:
             self.sortorder = None
-            ordered_neighbors = neighbors
-        else:
-            if self.sortorder is None:
-                self.sortorder = self.sortorderlist[0]
-            ordered_neighbors = sorted(neighbors,
-                                       key=lambda k: k[self.sortcolumn],
-                                       reverse=revso)
-
-        # Show Neighbors
-        for neighbor in ordered_neighbors:
-            self.show_neighbor(row, neighbor, cwl, cw, height)
+        elif self.sortorder is None:
+            self.sortorder = self.sortorderlist[0]
+        ordered_neighbors = self.orderedNeighbors(neighbors)
+
+        # Show only the neighbors that fit on the screen
+        self.page_size = max(bottom - row, 1)
+        self.scroll = max(min(self.scroll,
+                              len(ordered_neighbors) - self.page_size), 0)
+        visible = ordered_neighbors[self.scroll:self.scroll + self.page_size]
+        for neighbor in visible:
+            self.show_neighbor(row, neighbor, cwl, cw, bottom + 2)
             row += 1
 
-        # Blank spare neighbor rows
-        for blankrow in range(row, height - 2):
-            print(self.term.move(blankrow, 0) + " " * width)
-
-        print(self.term.move(height - 2, 0 * cw) +
-              self.term.black_on_cyan(
-                    "Q to exit - "
-                    "B to reset tx to a zero baseline - "
-                    "O to obscure addresses - "
-                    "S# to sort column".ljust(width)))
-
-        ITER += 1
-
-    def txString(self, neighbor, key, keydelta, keyshort, column_width):
-        txcnt = neighbor[key] - (self.baseline[self.getBaselineKey(neighbor,
-                                 keyshort)] * self.baselineToggle)
-        return ("%d (%d)" % (txcnt, neighbor[keydelta])).rjust(column_width)
+        status = " %d-%d of %d  %d B/frame  CPU %.1f%% " % (
+                 self.scroll + 1 if visible else 0,
+                 self.scroll + len(visible),
+                 len(ordered_neighbors),
+                 self.screen.frame_bytes,
+                 self.cpu_usage)
+        if self.error is not None:
+            # Failed poll, the data shown is from the last good one
+            self.screen.write(height - 2, 0 * cw,
+                              self.term.white_on_red(
+                                  self.error.replace('\n', ' ')
+                                  .ljust(width - len(status))
+                                  [:width - len(status)] + status))
+        elif self.notice is not None:
+            self.screen.write(height - 2, 0 * cw,
+                              self.term.black_on_yellow(
+                                  self.notice.ljust(width - len(status))
+                                  [:width - len(status)] + status))
+        else:
+            self.screen.write(height - 2, 0 * cw,
+                              self.term.black_on_cyan(
+                                  ("Q to exit - "
+                                   "B to reset tx to a zero baseline - "
+                                   "O to obscure addresses - "
+                                   "E to show events - "
+                                   "V to view tx per poll/second - "
+                                   "S# to sort column - "
+                                   "PgUp/PgDn to scroll")
+                                  .ljust(width - len(status))
+                                  [:width - len(status)] + status))
+
+    def show_event_log(self, bottom):
+        """
+        Show the latest neighbor events, newest first, above row
+        bottom. Return the first row used.
+        """
+        width = self.width
+        rows = min(EVENT_ROWS, (bottom - 10) // 2)
+        if rows < 2:
+            return bottom
+        top = bottom - rows
+        self.screen.write(top, 0, self.term.black_on_green(
+                          ("Neighbor Events (%d)" % len(self.events))
+                          .ljust(width)[:width]))
+        colors = {'joined': self.term.green, 'left': self.term.yellow,
+                  'reset': self.term.yellow, 'incommunicado': self.term.red,
+                  'communicating': self.term.white}
+        for i in range(rows - 1):
+            if i >= len(self.events):
+                self.screen.write(top + 1 + i, 0, " " * width)
+                continue
+            event = self.events[-1 - i]
+            text = "%s  %-14s %s://%s" % (
+                   time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.localtime(event.timestamp)),
+                   event.kind, event.connection_type,
+                   self.showAddress(event.address, cache=False))
+            self.screen.write(top + 1 + i, 0, colors[event.kind](
+                              text.ljust(width)[:width]))
+        return top
+
+    def txString(self, neighbor, i, column_width):
+        view = COUNTER_VIEWS[self.view][0]
+        if view == 'per-poll':
+            return str(neighbor.deltas[i]).rjust(column_width)
+        if view == 'per-second':
+            # Smoothed over 1m (5m)
+            return ("%s (%s)" % tuple("-" if ewma[i] != ewma[i]
+                                      else "%.1f" % ewma[i]
+                                      for ewma in neighbor.ewma)
+                    ).rjust(column_width)
+        txcnt = neighbor.counters[i] - (neighbor.baseline[i] *
+                                        self.baselineToggle)
+        return ("%d (%d)" % (txcnt, neighbor.deltas[i])).rjust(column_width)
 
     def show_neighbor(self, row, neighbor, column_start_list,
                       column_width, height):
-        global ITER
-
-        neighbor['addr'] = self.showAddress(neighbor['connectionType'] +
-                                            "://" + neighbor['address'])
 
-        # Create display string
-        for txkey in self.txkeys[1:]:
-            neighbor[txkey['keyshort']] = \
-                    self.txString(neighbor,
-                                  txkey['key'],
-                                  '%sDelta' % txkey['key'],
-                                  txkey['keyshort'],
-                                  column_width)
+        addr = (neighbor.connection_type + "://" +
+                self.showAddress(neighbor.address))
 
         # Highlight neighbors that are incommunicado
-        incommunicado = False
-        if (neighbor['numberOfAllTransactionsDelta'] == 0 and
-                ITER > (6 * self.poll_delay)):
-            neighbor['addr'] = "(!) " + neighbor['addr']
-            incommunicado = True
-            self.incommunicados += 1
+        incommunicado = neighbor.incommunicado
+        if incommunicado:
+            addr = "(!) " + addr
 
         # Pad/Trim neighbor address
         ncolw = 3 * (column_width + 1)
-        if len(neighbor['addr']) < ncolw:
+        if len(addr) < ncolw:
             # pad
-            neighbor['addr'] = neighbor['addr'].ljust(ncolw, ' ')
-        elif len(neighbor['addr']) > ncolw:
+            addr = addr.ljust(ncolw, ' ')
+        elif len(addr) > ncolw:
             # trim
-            neighbor['addr'] = neighbor['addr'][0:ncolw]
-
-        value_at = "neighbor-%s-at" % neighbor['address']
-        if (value_at in self.prev and
-                neighbor['numberOfAllTransactions'] != self.prev[value_at]):
-            neighbor['at'] = self.term.cyan(neighbor['at'])
-
-        if neighbor['numberOfInvalidTransactions'] > 0:
-            neighbor['it'] = \
-                self.term.red(str(neighbor['numberOfInvalidTransactions'])
-                              .rjust(column_width))
-
-        # Blink changed value
-        for txkey in self.txkeys[1:]:
-            neighborkey = "neighbor-%s-%s" % (neighbor['address'],
-                                              txkey['keyshort'])
-            if (neighborkey in self.prev and
-                    neighbor[txkey['key']] != self.prev[neighborkey]):
-                neighbor[txkey['keyshort']] = \
-                    self.term.cyan(neighbor[txkey['keyshort']])
+            addr = addr[0:ncolw]
 
         # do not display any neighbors crossing the height of the terminal
         if row < height - 2:
-            print(self.term.move(row, column_start_list[0]) +
-                  (self.term.white(neighbor['addr']) if not incommunicado
-                  else self.term.red(neighbor['addr'])))
-            for txkey in self.txkeys[1:]:
-                print(self.term.move(row, column_start_list[txkey['col']]) +
-                      self.term.green(neighbor[txkey['keyshort']]))
+            self.screen.write(row, column_start_list[0],
+                              self.term.white(addr)
+                              if not incommunicado
+                              else self.term.red(addr))
+
+            counters, shown = neighbor.counters, neighbor.shown
+            for i, txkey in enumerate(self.txkeys[1:]):
+                if i == self.invalid_index and counters[i] > 0:
+                    tx = self.term.red(
+                         str(counters[i]).rjust(column_width) if
+                         self.view == 0 else
+                         self.txString(neighbor, i, column_width))
+                else:
+                    tx = self.txString(neighbor, i, column_width)
+
+                # Blink changed value
+                if shown is not None and counters[i] != shown[i]:
+                    tx = self.term.cyan(tx)
+                    self.blinking = True
+
+                self.screen.write(row, column_start_list[txkey['col']],
+                                  self.term.green(tx))
 
         # Store previous value
-        for txkey in self.txkeys[1:]:
-            neighborkey = "neighbor-%s-%s" % (neighbor['address'],
-                                              txkey['keyshort'])
-            self.prev[neighborkey] = neighbor[txkey['key']]
+        neighbor.shown = array('l', neighbor.counters)
+
+
+class Fleet(object):
+    """
+    Summary of many nodes, one row per node, with a drill-down into
+    the view of a single node
+
+    Every node has its own IriTop, fed by its own Poller. The pollers
+    are run by a FleetPoller.
+    """
+
+    def __init__(self, args, nodes):
+        self.term = Terminal()
+        self.screen = Screen(self.term)
+        self.blink_delay = args.blink_delay
+        self.members = []
+        for node in OrderedDict.fromkeys(nodes):
+            member = IriTop(args, node=node, term=self.term)
+            member.record_file = None
+            member.shared_cache = None
+            self.members.append(member)
+        self.pollers = [member.poller() for member in self.members]
+        self.fleet_poller = FleetPoller(self.pollers,
+                                        args.fleet_workers or FLEET_WORKERS)
+        self.columns = [('Node', 0.28), ('Version', 0.12),
+                        ('Milestone', 0.09), ('Solid lag', 0.08),
+                        ('Behind', 0.07), ('Neighbors', 0.08),
+                        ('Incomm.', 0.07), ('p95 ms', 0.07), ('Age', 0.06),
+                        ('Status', 0.08)]
+        self.selected = 0
+        self.scroll = 0
+        self.page_size = 1
+        self.width = 0
+        self.height = 0
+
+    def run(self, stdscr):
+        stdscr.clear()
+
+        self.screen.sync = sync_update_supported(self.term)
+        for member in self.members:
+            member.screen.sync = self.screen.sync
+
+        self.fleet_poller.start()
+        try:
+            with self.term.hidden_cursor():
+                self.loop()
+        finally:
+            self.fleet_poller.stop()
+
+    def loop(self):
+        val = ""
+        redraw = True
+
+        while val.lower() != 'q':
+            val = self.term.inkey(timeout=self.blink_delay)
+
+            if val.code == self.term.KEY_UP:
+                self.selected -= 1
+            elif val.code == self.term.KEY_DOWN:
+                self.selected += 1
+            elif val.code == self.term.KEY_PGUP:
+                self.selected -= self.page_size
+            elif val.code == self.term.KEY_PGDOWN:
+                self.selected += self.page_size
+            elif val.code == self.term.KEY_HOME:
+                self.selected = 0
+            elif val.code == self.term.KEY_END:
+                self.selected = len(self.members) - 1
+            self.selected = max(min(self.selected, len(self.members) - 1), 0)
+
+            if val.code == self.term.KEY_ENTER or val in ('\n', '\r'):
+                # Q in the node view comes back here. The other nodes
+                # keep processing their snapshots meanwhile, their
+                # queues do not grow and their state stays current.
+                selected = self.selected
+                self.members[selected].loop(self.pollers[selected],
+                                            lambda: self.process(selected))
+                self.screen.invalidate()
+                val = ""
+                redraw = True
+
+            height, width = self.term.height, self.term.width
+            if (height, width) != (self.height, self.width):
+                self.height, self.width = height, width
+                self.screen.invalidate()
+                redraw = True
+
+            if self.process() or redraw or val:
+                redraw = False
+                self.draw()
+
+    def process(self, skip=None):
+        """
+        Process the snapshots of all nodes but the one at index skip,
+        return whether there were any
+        """
+        updated = False
+        for i, (member, poller) in enumerate(zip(self.members,
+                                                 self.pollers)):
+            if i != skip and member.process(poller):
+                updated = True
+        return updated
+
+    def draw(self):
+        """ Draw the summary of all nodes """
+        width = self.width
+        milestones = [m.node['latestMilestoneIndex'] for m in self.members
+                      if m.node is not None]
+        newest = max(milestones) if milestones else None
+        failing = len([m for m in self.members if m.error is not None])
+        up = len([m for m in self.members
+                  if m.node is not None and m.error is None])
+
+        self.screen.write(0, 0, self.term.black_on_cyan(
+                          ("IRITop - Simple IOTA IRI Node Monitor (%s)"
+                           " - Fleet" % __VERSION__).ljust(width)))
+        self.screen.write(1, 0,
+                          self.term.cyan("Nodes: ") +
+                          "%d  " % len(self.members) +
+                          self.term.cyan("Up: ") +
+                          "%d  " % up +
+                          self.term.cyan("Failing: ") +
+                          (self.term.red("%d" % failing) if failing
+                           else "0") + "  " +
+                          self.term.cyan("Latest Milestone: ") +
+                          ("-" if newest is None else "%d" % newest) +
+                          "          ")
+
+        widths = [int(width * share) for header, share in self.columns]
+        widths[0] += width - sum(widths)
+        self.screen.write(3, 0, self.term.black_on_green(
+                          "".join(header.ljust(w) if i == 0
+                                  else header[:w - 1].rjust(w)
+                                  for i, ((header, share), w) in
+                                  enumerate(zip(self.columns, widths)))))
+
+        row = 4
+        self.page_size = max(self.height - 2 - row, 1)
+        if self.selected < self.scroll:
+            self.scroll = self.selected
+        elif self.selected >= self.scroll + self.page_size:
+            self.scroll = self.selected - self.page_size + 1
+        visible = self.members[self.scroll:self.scroll + self.page_size]
+        pollers = self.pollers[self.scroll:self.scroll + self.page_size]
+        for i, (member, poller) in enumerate(zip(visible, pollers)):
+            cells = self.summary(member, poller, newest)
+            line = "".join(str(cell)[:w - 1].ljust(w) if c == 0
+                           else str(cell)[:w - 1].rjust(w)
+                           for c, (cell, w) in enumerate(zip(cells, widths)))
+            if self.scroll + i == self.selected:
+                line = self.term.reverse(line)
+            elif member.error is not None:
+                line = self.term.red(line)
+            self.screen.write(row, 0, line)
+            row += 1
+        for row in range(row, self.height - 2):
+            self.screen.write(row, 0, " " * width)
+
+        status = " %d-%d of %d " % (self.scroll + 1 if visible else 0,
+                                    self.scroll + len(visible),
+                                    len(self.members))
+        self.screen.write(self.height - 2, 0, self.term.black_on_cyan(
+                          ("Q to exit - "
+                           "Up/Down to select - "
+                           "Enter to show the node (Q to come back)")
+                          .ljust(width - len(status))
+                          [:width - len(status)] + status))
+        self.screen.flush()
+
+    def summary(self, member, poller, newest):
+        """ Cells of the summary row of member """
+        address = member.showAddress(member.node_url)
+        if member.snapshot_time is None:
+            return [address, '-', '-', '-', '-', '-', '-', '-', '-',
+                    'error' if member.error is not None else 'polling']
+        node = member.node
+        status = 'ok'
+        if member.error is not None:
+            status = 'error'
+        elif member.lagging(poller):
+            status = 'lagging'
+        return [address,
+                node['appVersion'],
+                node['latestMilestoneIndex'],
+                node['latestMilestoneIndex'] -
+                node['latestSolidSubtangleMilestoneIndex'],
+                newest - node['latestMilestoneIndex'],
+                node['neighbors'],
+                member.incommunicados,
+                member.latency.percentile(95),
+                "%.0f s" % (member.clock() - member.snapshot_time),
+                status]
 
 
 if __name__ == '__main__':
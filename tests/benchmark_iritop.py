@@ -0,0 +1,304 @@
+"""
+Benchmark of iritop polling and rendering a synthetic node
+
+Runs the stub node API of test_iritop.py with 10, 100, 1,000 and
+10,000 neighbors and measures for each size:
+
+- poll latency of getNeighbors and getNodeInfo together (ms)
+- time to process a snapshot in IriTop.update (ms)
+- time to draw a frame and bytes written to the terminal, for the
+  first (full) frame and for the frames after a poll
+- peak memory allocated by iritop while polling and drawing (python 3)
+
+Results are written as JSON, so that versions can be compared:
+
+    python tests/benchmark_iritop.py -o before.json
+    python tests/benchmark_iritop.py -o after.json --compare before.json
+"""
+from __future__ import division
+import argparse
+import json
+import platform
+import socket
+import subprocess
+import sys
+import time
+from os import path
+
+try:
+    import tracemalloc  # python 3
+except ImportError:
+    tracemalloc = None
+
+try:
+    from io import StringIO
+except ImportError:
+    from StringIO import StringIO  # python 2
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.append(path.dirname(path.abspath(__file__)))
+
+import iritop  # noqa: E402
+from test_iritop import (HTTPHandler, ThreadedHTTPServer,  # noqa: E402
+                         testHTTPServer, is_open, Struct)
+
+
+SIZES = [10, 100, 1000, 10000]
+POLLS = 20
+ROWS = 50
+COLUMNS = 160
+
+
+class SyntheticHandler(HTTPHandler):
+    """ Node API serving the neighbors of the synthetic node """
+
+    # Headers and body are written separately, don't let them wait
+    # for a delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def _process_data(self, data):
+        if data.get('command') != 'getNeighbors':
+            return HTTPHandler._process_data(self, data)
+
+        # Bodies are encoded upfront, so that the time spent by the
+        # stub is not measured as poll latency
+        body = self.server.bodies[self.server.polls %
+                                  len(self.server.bodies)]
+        self.server.polls += 1
+        self._set_headers(200, len(body))
+        self.wfile.write(body)
+
+
+def neighbors_body(size, poll):
+    """ getNeighbors response of size neighbors, counters grow per poll """
+    neighbors = []
+    for i in range(size):
+        neighbors.append({
+            "address": "node%05d.example.com:%d" % (i, 14600 + i % 1000),
+            "connectionType": "tcp" if i % 3 else "udp",
+            "numberOfAllTransactions": 100000 + i * 7 + poll * (i % 13),
+            "numberOfInvalidTransactions": poll * (i % 5 == 0),
+            "numberOfNewTransactions": 20000 + i * 3 + poll * (i % 7),
+            "numberOfRandomTransactionRequests": 1000 + poll * (i % 2),
+            "numberOfSentTransactions": 110000 + i + poll * (i % 11),
+            "numberOfStaleTransactions": 3000 + poll * (i % 3)
+        })
+    return json.dumps({"duration": 0,
+                       "neighbors": neighbors}).encode('utf-8')
+
+
+def serve(port, size, polls):
+    """ Run the synthetic node until killed """
+    httpd = ThreadedHTTPServer(('127.0.0.1', port), SyntheticHandler)
+    httpd.bodies = [neighbors_body(size, poll) for poll in range(polls)]
+    httpd.polls = 0
+    httpd.serve_forever()
+
+
+class Terminal(iritop.Terminal):
+    """ Terminal of a fixed size, whatever iritop runs in """
+    height = ROWS
+    width = COLUMNS
+
+
+def counts(value):
+    """ Comma separated list of neighbor counts """
+    try:
+        sizes = [int(size) for size in value.split(',')]
+    except ValueError:
+        sizes = []
+    if not sizes or min(sizes) < 0:
+        raise argparse.ArgumentTypeError("Invalid neighbor count(s): %s" %
+                                         value)
+    return sizes
+
+
+def summary(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {'mean': round(sum(values) / len(values), 3),
+            'p50': round(values[(len(values) - 1) // 2], 3),
+            'p95': round(values[int(-(-95 * len(values) // 100)) - 1], 3),
+            'max': round(values[-1], 3)}
+
+
+def iri_top():
+    """ IriTop drawing to a string instead of the terminal """
+    it = iritop.IriTop(Struct(poll_delay=1,
+                              blink_delay=0.5,
+                              obscure_address=False,
+                              username='nobody',
+                              password='secret',
+                              sort=-2,
+                              record=None,
+                              replay=None,
+                              speed=1.0,
+                              poll_schedule=None,
+                              adaptive_poll=None,
+                              shared_cache=None,
+                              viewer=None,
+                              evict_after=iritop.NEIGHBOR_TTL,
+                              max_neighbors=iritop.NEIGHBOR_LIMIT))
+    stream = StringIO()
+    it.term = Terminal(kind='xterm-256color', stream=stream,
+                       force_styling=True)
+    it.screen = iritop.Screen(it.term, stream=stream)
+    it.height, it.width = it.term.height, it.term.width
+    return it, stream
+
+
+def run(it, stream, polls):
+    """ Poll and draw polls times, return the measurements """
+    poller = iritop.Poller(it.commands, it.poll_delay)
+    measured = {'poll_ms': [], 'update_ms': [], 'frame_ms': [],
+                'frame_bytes': []}
+
+    for i in range(polls):
+        start = iritop.monotonic()
+        results = iritop.fetch_concurrent(it.commands)
+        end = iritop.monotonic()
+        for data, error, duration in results:
+            if error is not None:
+                raise Exception(error)
+        snapshot = iritop.Snapshot(
+                   results=tuple(results),
+                   duration=int(round((end - start) * 1000)),
+                   time=end, timestamp=time.time())
+
+        start = iritop.monotonic()
+        it.update(snapshot)
+        measured['update_ms'].append((iritop.monotonic() - start) * 1000)
+
+        stream.seek(0)
+        stream.truncate()
+        start = iritop.monotonic()
+        it.draw(poller)
+        frame_ms = (iritop.monotonic() - start) * 1000
+
+        if i == 0:
+            measured['full_frame_ms'] = round(frame_ms, 3)
+            measured['full_frame_bytes'] = it.screen.frame_bytes
+        else:
+            measured['poll_ms'].append(snapshot.duration)
+            measured['frame_ms'].append(frame_ms)
+            measured['frame_bytes'].append(it.screen.frame_bytes)
+
+    return measured
+
+
+def benchmark(size, polls):
+    port = testHTTPServer.find_free_port()
+    server = subprocess.Popen([sys.executable, path.abspath(__file__),
+                               '--serve', str(port), str(size),
+                               str(polls)])
+    try:
+        while not is_open('127.0.0.1', port):
+            if server.poll() is not None:
+                raise Exception("Synthetic node exited")
+            time.sleep(0.1)
+
+        iritop.NODE = 'http://127.0.0.1:%d' % port
+        iritop.CLIENTS.clear()
+
+        it, stream = iri_top()
+        measured = run(it, stream, polls)
+        result = {'neighbors': size}
+        for key, values in measured.items():
+            result[key] = summary(values) if isinstance(values, list) \
+                else values
+
+        # Separate run, tracing allocations slows everything down
+        result['peak_memory_mb'] = None
+        if tracemalloc is not None:
+            tracemalloc.start()
+            it, stream = iri_top()
+            run(it, stream, 3)
+            result['peak_memory_mb'] = round(
+                tracemalloc.get_traced_memory()[1] / iritop.MB, 3)
+            tracemalloc.stop()
+
+        return result
+    finally:
+        server.kill()
+        server.wait()
+
+
+def compare(old, new):
+    """ Print the change of every measurement against old results """
+    previous = dict((r['neighbors'], r) for r in old['results'])
+    print("%-10s %-20s %12s %12s %8s" % ('neighbors', 'measurement',
+                                         old['version'], new['version'],
+                                         'change'))
+    for result in new['results']:
+        if result['neighbors'] not in previous:
+            continue
+        for key in sorted(result):
+            was = previous[result['neighbors']].get(key)
+            now = result[key]
+            if isinstance(now, dict):
+                was, now = (was or {}).get('mean'), now['mean']
+                key += ' mean'
+            if key == 'neighbors' or not was or now is None:
+                continue
+            print("%-10d %-20s %12s %12s %+7.1f%%" %
+                  (result['neighbors'], key, was, now,
+                   100.0 * (now - was) / was))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark iritop against a synthetic node")
+    parser.add_argument("-n", "--neighbors", type=counts,
+                        default=SIZES,
+                        help="Comma separated neighbor counts."
+                             " Default: %s" % ",".join(map(str, SIZES)))
+    parser.add_argument("-p", "--polls", type=int, default=POLLS,
+                        help="Polls per neighbor count. Default: %d" %
+                             POLLS)
+    parser.add_argument("-o", "--output", type=str,
+                        help="Write the results as JSON to OUTPUT")
+    parser.add_argument("--compare", type=str, metavar='FILE',
+                        help="Compare with the results in FILE")
+    parser.add_argument("--serve", nargs=3, type=int,
+                        metavar=('PORT', 'NEIGHBORS', 'POLLS'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(*args.serve)
+        return
+
+    results = {'version': iritop.__VERSION__,
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'host': socket.gethostname(),
+               'time': round(time.time()),
+               'polls': args.polls,
+               'terminal': [ROWS, COLUMNS],
+               'results': []}
+
+    for size in args.neighbors:
+        result = benchmark(size, max(args.polls, 2))
+        sys.stderr.write("%6d neighbors: poll %.1f ms, update %.1f ms,"
+                         " frame %.1f ms / %d bytes, memory %s MB\n" %
+                         (size, result['poll_ms']['mean'],
+                          result['update_ms']['mean'],
+                          result['frame_ms']['mean'],
+                          result['frame_bytes']['mean'],
+                          result['peak_memory_mb']))
+        results['results'].append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,22 @@ import unittest
 import logging
 import time
 import json
+import math
+import random
 import sys
-from os import path
+import shutil
+import tempfile
+from os import path, stat, symlink
 from functools import wraps
 from contextlib import (contextmanager, closing)
 
 
 try:
     from BaseHTTPServer import (BaseHTTPRequestHandler, HTTPServer)
+    from SocketServer import ThreadingMixIn
 except ImportError:
     from http.server import (BaseHTTPRequestHandler, HTTPServer)  # python 3
+    from socketserver import ThreadingMixIn  # python 3
 
 try:
     from cStringIO import StringIO
@@ -26,6 +32,7 @@ except ImportError:
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
 import iritop # noqa
+from blessed.keyboard import Keystroke # noqa
 
 LOG = logging.getLogger(__name__)
 
@@ -142,6 +149,375 @@ class TestArgParser(unittest.TestCase):
                                                 else "forward"))
             self.assertEqual(it.sortcolumn, st['col'])
 
+        """ Column 0 does not sort """
+        self.set_new_args(['--sort=0'])
+        self.assertIsNone(iritop.IriTop(self.args).sortcolumn)
+
+    def test_poll_schedule(self):
+        """ Test per command poll delays, extra commands are polled too """
+        self.set_new_args(['--poll-delay=2',
+                           '--poll-schedule=getNodeInfo=10,getTips=30'])
+        it = iritop.IriTop(self.args)
+        self.assertEqual([c['command'] for c in it.commands],
+                         ['getNeighbors', 'getNodeInfo', 'getTips'])
+        self.assertEqual(it.intervals, [2, 10, 30])
+
+        with self.assertRaises(SystemExit):
+            with captured_output():
+                self.set_new_args(['--poll-schedule=getNodeInfo'])
+
+    def test_multi_column_sort(self):
+        """
+        Test sorting ties by more columns, and caching of the order
+        """
+        self.set_new_args(['--sort=6,0,-1'])
+        it = iritop.IriTop(self.args)
+        """ Column 0 does not sort ties """
+        self.assertEqual(len(it.sortthen), 1)
+        neighbors = [it.historizer(data) for data in [
+            {'address': 'b:1', 'numberOfInvalidTransactions': 0},
+            {'address': 'c:1', 'numberOfInvalidTransactions': 2},
+            {'address': 'a:1', 'numberOfInvalidTransactions': 0},
+            {'address': 'd:1', 'numberOfInvalidTransactions': 2},
+        ]]
+
+        ordered = it.orderedNeighbors(neighbors)
+        self.assertEqual([n.address for n in ordered],
+                         ['c:1', 'd:1', 'a:1', 'b:1'])
+
+        """ Same snapshot and sort columns reuse the order """
+        self.assertIs(it.orderedNeighbors(neighbors), ordered)
+
+        """ Reversing the tie column sorts again """
+        it.sortThen(it.txkeys[0]['sortkey'])
+        ordered = it.orderedNeighbors(neighbors)
+        self.assertEqual([n.address for n in ordered],
+                         ['d:1', 'c:1', 'b:1', 'a:1'])
+
+
+class TestNeighbor(unittest.TestCase):
+
+    def setUp(self):
+        self.iri_top = iritop.IriTop(Struct(poll_delay=1,
+                                            blink_delay=0.5,
+                                            obscure_address=False,
+                                            username=None,
+                                            sort=None,
+                                            record=None,
+                                            replay=None,
+                                            speed=1.0,
+                                            poll_schedule=None,
+                                            adaptive_poll=None,
+                                            shared_cache=None,
+                                            viewer=None,
+                                            evict_after=3,
+                                            max_neighbors=4))
+
+    def poll(self, *neighbors):
+        self.iri_top.polls += 1
+        return [self.iri_top.historizer(data) for data in neighbors]
+
+    def test_deltas(self):
+        """ Test counters and deltas are kept per neighbor between polls """
+        first, = self.poll({'address': 'a:1', 'connectionType': 'tcp',
+                            'numberOfAllTransactions': 10})
+        self.assertEqual(first.deltas[0], 0)
+
+        second, = self.poll({'address': 'a:1', 'connectionType': 'tcp',
+                             'numberOfAllTransactions': 15})
+        self.assertIs(first, second)
+        self.assertEqual(second.counters[0], 15)
+        self.assertEqual(second.deltas[0], 5)
+
+        """ Missing counters count as zero """
+        self.assertEqual(second.counters[self.iri_top.invalid_index], 0)
+
+    def test_neighbor_returns(self):
+        """ Test no delta for a neighbor missing from the previous poll """
+        self.poll({'address': 'a:1', 'numberOfAllTransactions': 10})
+        self.poll({'address': 'b:1', 'numberOfAllTransactions': 10})
+        neighbor, = self.poll({'address': 'a:1',
+                               'numberOfAllTransactions': 20})
+        self.assertEqual(neighbor.deltas[0], 0)
+
+        """ Ids are stable per address """
+        self.assertNotEqual(neighbor.id,
+                            self.iri_top.neighbor_map['b:1'].id)
+
+    def test_rates(self):
+        """ Test rates per second of the response times, and their ewma """
+        it = self.iri_top
+
+        def update(now, count, ms=10, duration=10):
+            neighbors = [{'address': 'a:1', 'numberOfAllTransactions': count}]
+            it.update(iritop.Snapshot(
+                results=(({'neighbors': neighbors}, None, ms), None),
+                duration=duration, time=now, timestamp=now))
+            return it.neighbor_map['a:1']
+
+        update(10.0, 100)
+        update(12.0, 120)
+        # Response 0.5 s before the end of the poll
+        neighbor = update(17.0, 165, ms=100, duration=600)
+        self.assertEqual(neighbor.rates[0], 10)
+        self.assertAlmostEqual(neighbor.ewma[0][0], 10)
+        self.assertEqual(neighbor.deltas[0], 45)
+
+        it.view = 1
+        self.assertEqual(it.txString(neighbor, 0, 6), '    45')
+        it.view = 2
+        self.assertEqual(it.txString(neighbor, 0, 12), ' 10.0 (10.0)')
+
+        """ The average moves towards new rates by the time passed """
+        neighbor = update(22.5, 165)
+        self.assertAlmostEqual(neighbor.ewma[0][0], 10 * math.exp(-0.1))
+        self.assertAlmostEqual(neighbor.ewma[1][0], 10 * math.exp(-0.02))
+        self.assertEqual(it.tx_ewma[0], ('1m', neighbor.ewma[0][0]))
+
+        """ No rate across a reset, nor for a neighbor that came back """
+        neighbor = update(24.5, 5)
+        self.assertNotEqual(neighbor.rates[0], neighbor.rates[0])
+        it.polls += 1
+        neighbor = update(30, 5)
+        self.assertNotEqual(neighbor.ewma[0][0], neighbor.ewma[0][0])
+        self.assertEqual(it.txString(neighbor, 0, 8), ' - (-)'.rjust(8))
+
+    def test_eviction(self):
+        """ Test neighbors that left are forgotten after evict_after polls """
+        self.poll({'address': 'a:1'}, {'address': 'b:1'})
+        self.iri_top.evict(2)
+        for i in range(3):
+            self.poll({'address': 'a:1'})
+            self.iri_top.evict(1)
+        self.assertIn('b:1', self.iri_top.neighbor_map)
+        self.poll({'address': 'a:1'})
+        self.iri_top.evict(1)
+        self.assertEqual(list(self.iri_top.neighbor_map), ['a:1'])
+
+        """ Above max_neighbors the ones absent longest go first """
+        for address in ('b:1', 'c:1', 'd:1', 'e:1'):
+            self.poll({'address': address})
+            self.iri_top.evict(1)
+        self.assertEqual(sorted(self.iri_top.neighbor_map),
+                         ['b:1', 'c:1', 'd:1', 'e:1'])
+
+        """ Neighbors of the last poll are kept whatever the limit """
+        self.poll(*[{'address': '%d:1' % i} for i in range(6)])
+        self.iri_top.evict(6)
+        self.assertEqual(len(self.iri_top.neighbor_map), 6)
+        self.assertTrue(self.iri_top.state_size() > 0)
+
+    def test_events(self):
+        """ Test joins, leaves, resets and incommunicados are logged """
+        def update(**counts):
+            neighbors = [{'address': a, 'connectionType': 'tcp',
+                          'numberOfAllTransactions': n}
+                         for a, n in sorted(counts.items())]
+            self.iri_top.update(iritop.Snapshot(
+                results=(({'neighbors': neighbors}, None, 1), None),
+                duration=1, time=1, timestamp=1))
+            return [(e.kind, e.address) for e in self.iri_top.new_events]
+
+        self.assertEqual(update(a=10, b=10), [])
+        self.assertEqual(update(a=20, c=10),
+                         [('joined', 'c'), ('left', 'b')])
+        self.assertEqual(update(a=5, c=20), [('reset', 'a')])
+        self.assertEqual(update(a=15, c=20), [('incommunicado', 'c')])
+        self.assertEqual(update(a=25, c=30), [('communicating', 'c')])
+        self.assertEqual(update(a=35, c=40), [])
+        self.assertEqual(len(self.iri_top.events), 5)
+
+    def test_obscured_address(self):
+        """ Test addresses are obscured the same way until they leave """
+        it = self.iri_top
+        it.obscureAddrToggle = 1
+        state = random.getstate()
+        obscured = it.showAddress('10.0.0.1:14600')
+        self.assertNotEqual(obscured, '10.0.0.1:14600')
+        self.assertEqual(obscured[2:7:2] + obscured[8], '...:')
+        self.assertTrue(it.showAddress('http://node:14265')
+                        .startswith('http://'))
+        self.assertEqual(random.getstate(), state)
+
+        """ Same key, same obscured address, without the cache """
+        self.assertEqual(iritop.scrambleAddress('10.0.0.1:14600',
+                                                it.obscure_key), obscured)
+
+        def snapshot(*addresses):
+            neighbors = [{'address': a, 'numberOfAllTransactions': 1}
+                         for a in addresses]
+            return iritop.Snapshot(results=(({'neighbors': neighbors},
+                                             None, 1), None),
+                                   duration=1, time=1, timestamp=1)
+
+        it.update(snapshot('10.0.0.1:14600', '10.0.0.2:14600'))
+        it.showAddress('10.0.0.2:14600')
+        it.update(snapshot('10.0.0.2:14600'))
+        self.assertNotIn('10.0.0.1:14600', it.obscured)
+        self.assertIn('10.0.0.2:14600', it.obscured)
+
+
+class TestSeriesStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = iritop.SeriesStore(counters=2, span=60, resolution=10)
+
+    def neighbor(self, nid, all_tx, new_tx):
+        neighbor = iritop.Neighbor(nid, 'n%d:1' % nid, 'tcp', 2)
+        neighbor.counters[0], neighbor.counters[1] = all_tx, new_tx
+        return neighbor
+
+    def test_rates(self):
+        """ Test windowed rates over all neighbors """
+        for t in range(0, 130, 10):
+            self.store.sample(t, [self.neighbor(0, t * 3, t),
+                                  self.neighbor(1, t * 5, t)])
+
+        self.assertAlmostEqual(self.store.total_rate(60), 8.0)
+        self.assertAlmostEqual(self.store.total_rate(60, counter=1), 2.0)
+
+        """ Windows longer than the history use the oldest sample """
+        self.assertAlmostEqual(self.store.total_rate(600), 8.0)
+
+    def test_reset(self):
+        """ Test counters going down do not make the rates negative """
+        for t in range(0, 70, 10):
+            self.store.sample(t, [self.neighbor(0, 10 ** 6 + t * 20, 0),
+                                  self.neighbor(1, t * 20, 0)])
+        for t in range(70, 100, 10):
+            self.store.sample(t, [self.neighbor(0, (t - 70) * 20, 0),
+                                  self.neighbor(1, t * 20, 0)])
+
+        """ Neighbor 0 is left out until the window is past the reset """
+        self.assertAlmostEqual(self.store.total_rate(60), 20.0)
+        self.assertAlmostEqual(self.store.total_rate(20), 40.0)
+
+        """ Also when it went away in between """
+        self.store.sample(100, [self.neighbor(1, 2000, 0)])
+        self.store.sample(110, [self.neighbor(0, 0, 0),
+                                self.neighbor(1, 2200, 0)])
+        self.assertAlmostEqual(self.store.total_rate(60), 20.0)
+
+    def test_bounded_memory(self):
+        """ Test ring size and slots stay bounded as neighbors churn """
+        for t in range(0, 10000, 10):
+            self.store.sample(t, [self.neighbor(t, t, t)])
+
+        self.assertEqual(len(self.store.rows), self.store.size)
+        self.assertLessEqual(len(self.store.slots), self.store.size)
+        self.assertLessEqual(self.store.width,
+                             2 * (self.store.size + 1))
+
+    def test_resolution(self):
+        """ Test polls faster than the resolution replace the newest """
+        for t in range(0, 100):
+            self.store.sample(t, [self.neighbor(0, t, 0)])
+
+        self.assertLessEqual(self.store.count, 12)
+        self.assertEqual(self.store.times[self.store.position(0)], 99)
+
+
+class TestRollingStats(unittest.TestCase):
+
+    def test_percentiles(self):
+        """ Test mean and percentiles over the rolling window """
+        stats = iritop.RollingStats(100)
+        for duration in range(1, 101):
+            stats.add(duration)
+
+        self.assertEqual(stats.mean, 50)
+        self.assertEqual(stats.percentile(50), 50)
+        self.assertEqual(stats.percentile(95), 95)
+        self.assertEqual(stats.percentile(99), 99)
+        self.assertEqual(stats.max, 100)
+        self.assertEqual(stats.last, 100)
+
+    def test_window(self):
+        """ Test old values drop out of the window """
+        stats = iritop.RollingStats(3)
+        for duration in [1000, 5, 1, 3]:
+            stats.add(duration)
+
+        self.assertEqual(list(stats.window), [5, 1, 3])
+        self.assertEqual(sum(stats.counts), 3)
+        self.assertEqual(stats.total, 9)
+        self.assertEqual(stats.max, 5)
+        self.assertEqual(stats.percentile(50), 3)
+
+    def test_buckets(self):
+        """ Test percentiles of long durations are close and bounded """
+        stats = iritop.RollingStats(1000)
+        for duration in range(1000, 3000, 2):
+            stats.add(duration)
+
+        for p in (50, 95, 99):
+            exact = 1000 + 2 * (p * 10 - 1)
+            self.assertGreaterEqual(stats.percentile(p), exact)
+            self.assertLessEqual(stats.percentile(p),
+                                 exact * iritop.LATENCY_GROWTH)
+        self.assertEqual(stats.percentile(100), 2998)
+        self.assertEqual(stats.max, 2998)
+
+        """ Past the last bucket the max is still exact """
+        stats.add(10 ** 9)
+        self.assertEqual(stats.percentile(100), 10 ** 9)
+
+
+class TestDeltaEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = [{'command': 'getNeighbors'},
+                         {'command': 'getNodeInfo'}]
+        self.encoder = iritop.DeltaEncoder()
+        self.decoder = iritop.DeltaDecoder()
+
+    def send(self, neighbors, node):
+        """ Encode and decode a snapshot, return the message sent """
+        results = (None if neighbors is None else
+                   ({'duration': 1, 'neighbors': neighbors}, None, 5),
+                   node)
+        snapshot = iritop.Snapshot(results=results, duration=5, time=1.0,
+                                   timestamp=1.0)
+        message = json.loads(json.dumps(
+                  self.encoder.encode(self.commands, snapshot)))
+        record = self.decoder.decode(message)
+        self.assertEqual(tuple(tuple(r) if r else r
+                               for r in record['results']), results)
+        return message
+
+    def test_deltas(self):
+        """ Test only changed fields and counters are sent """
+        a = {'address': 'a:1', 'numberOfAllTransactions': 10,
+             'numberOfNewTransactions': 3}
+        b = {'address': 'b:1', 'numberOfAllTransactions': 20,
+             'numberOfNewTransactions': 4}
+        node = ({'appName': 'IRI', 'tips': 5}, None, 3)
+        message = self.send([a, b], node)
+        self.assertTrue(message['full'])
+
+        a = dict(a, numberOfAllTransactions=11)
+        message = self.send([a, b], ({'appName': 'IRI', 'tips': 6}, None, 3))
+        self.assertNotIn('full', message)
+        self.assertEqual(message['results'][0]['lists'],
+                         {'neighbors': {'set': {
+                             'a:1': {'numberOfAllTransactions': 11}}}})
+        self.assertEqual(message['results'][1]['set'], {'tips': 6})
+
+        """ Neighbors leaving and joining send the new order """
+        c = {'address': 'c:1', 'numberOfAllTransactions': 0,
+             'numberOfNewTransactions': 0}
+        message = self.send([c, a], None)
+        self.assertEqual(message['results'][0]['lists']['neighbors']['order'],
+                         ['c:1', 'a:1'])
+        self.assertEqual(list(message['results'][0]['lists']['neighbors']
+                              ['set']), ['c:1'])
+
+        """ Failures are sent as is, the next data in full """
+        self.send([], (None, 'Timed out', 5000))
+        message = self.send([], ({'appName': 'IRI', 'tips': 6}, None, 3))
+        self.assertEqual(message['results'][1]['set'],
+                         {'appName': 'IRI', 'tips': 6})
+
 
 class TestFetchData(unittest.TestCase):
 
@@ -156,7 +532,16 @@ class TestFetchData(unittest.TestCase):
             'test': False,  # Remove?
             'password': 'secret',
             'username': 'nobody',
-            'sort': 3
+            'sort': 3,
+            'record': None,
+            'replay': None,
+            'speed': 1.0,
+            'poll_schedule': None,
+            'adaptive_poll': None,
+            'shared_cache': None,
+            'viewer': None,
+            'evict_after': iritop.NEIGHBOR_TTL,
+            'max_neighbors': iritop.NEIGHBOR_LIMIT
         }
 
         """ Get free port and set node address """
@@ -175,6 +560,7 @@ class TestFetchData(unittest.TestCase):
             time.sleep(0.2)
 
         """ IRITop instance """
+        self.args = args
         self.iri_top = iritop.IriTop(Struct(**args))
 
     def start_server(self):
@@ -189,7 +575,7 @@ class TestFetchData(unittest.TestCase):
         LOG.debug("getNeighbors result: %s" % str(result))
 
         """ Simply test expected number of keys returned from data """
-        self.assertEqual(len(result[0][0].keys()), 8)
+        self.assertEqual(len(result[0]['neighbors'][0].keys()), 8)
 
     def test_get_node_info(self):
         result = iritop.fetch_data({'command': 'getNodeInfo'})
@@ -198,6 +584,577 @@ class TestFetchData(unittest.TestCase):
         """ Simply test expected number of keys returned from data """
         self.assertEqual(len(result[0].keys()), 20)
 
+    def test_keep_alive(self):
+        """ Test connections are reused between calls """
+        client = iritop.get_client()
+        for i in range(3):
+            result, error = iritop.fetch_data({'command': 'getNodeInfo'})
+            self.assertIsNone(error)
+
+        LOG.debug("Connections: %d, reused: %d" % (client.connections,
+                                                   client.reused))
+        self.assertEqual(client.requests, 3)
+        self.assertEqual(client.connections, 1)
+        self.assertEqual(client.reused, 2)
+
+    def test_shared_client(self):
+        """ Test threads asking for a new node all get the same client """
+        interval = getattr(sys, 'getswitchinterval', lambda: None)()
+        if interval is not None:
+            # Switch threads as often as possible
+            sys.setswitchinterval(1e-6)
+        try:
+            for i in range(20):
+                node = 'http://127.0.0.1:%d/%d' % (i + 1, i)
+                clients = []
+                threads = [threading.Thread(
+                           target=lambda: clients.append(
+                               iritop.get_client(node)))
+                           for j in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(len(set(map(id, clients))), 1)
+                self.assertIs(clients[0], iritop.get_client(node))
+        finally:
+            if interval is not None:
+                sys.setswitchinterval(interval)
+
+    def test_fetch_concurrent(self):
+        """ Test commands are fetched in parallel and returned in order """
+        commands = [{'command': 'getNeighbors'}, {'command': 'getNodeInfo'}]
+        results = iritop.fetch_concurrent(commands)
+
+        self.assertEqual(len(results), 2)
+        for data, error, duration in results:
+            self.assertIsNone(error)
+            self.assertGreaterEqual(duration, 0)
+        self.assertEqual(len(results[0][0]['neighbors']), 2)
+        self.assertIn('appName', results[1][0])
+
+        """ Errors are returned per command instead of raised """
+        results = iritop.fetch_concurrent([{'command': 'invalid'}])
+        self.assertIsNone(results[0][0])
+        self.assertIsNotNone(results[0][1])
+
+    def test_poller(self):
+        """ Test the background poller publishes snapshots """
+        poller = iritop.Poller([{'command': 'getNodeInfo'}], poll_delay=0.1)
+        poller.start()
+        try:
+            snapshots = []
+            for i in range(50):
+                snapshots.extend(poller.drain())
+                if len(snapshots) >= 2:
+                    break
+                time.sleep(0.1)
+        finally:
+            poller.stop()
+
+        self.assertGreaterEqual(len(snapshots), 2)
+        self.assertLess(snapshots[0].time, snapshots[1].time)
+        data, error, duration = snapshots[0].results[0]
+        self.assertIsNone(error)
+        self.assertIn('appName', data)
+
+    def test_poll_schedule(self):
+        """ Test commands that are not due are left out of snapshots """
+        commands = [{'command': 'getNeighbors'}, {'command': 'getNodeInfo'}]
+        fetched = []
+
+        def fetch(commands):
+            fetched.append([c['command'] for c in commands])
+            return iritop.fetch_concurrent(commands)
+
+        poller = iritop.Poller(commands, 0.1, fetch=fetch,
+                               intervals=[0.1, 60])
+        poller.start()
+        try:
+            snapshots = []
+            for i in range(50):
+                snapshots.extend(poller.drain())
+                if len(snapshots) >= 3:
+                    break
+                time.sleep(0.1)
+        finally:
+            poller.stop()
+
+        self.assertEqual(fetched[:3], [['getNeighbors', 'getNodeInfo'],
+                                       ['getNeighbors'], ['getNeighbors']])
+        self.assertIsNone(snapshots[1].results[1])
+
+        """ Node info of the previous snapshot is kept """
+        for snapshot in snapshots[:3]:
+            self.iri_top.update(snapshot)
+        self.assertEqual(self.iri_top.node['appName'], 'IRI')
+        self.assertEqual(self.iri_top.polls, 3)
+        self.assertEqual(len(self.iri_top.cmd_latency['getNodeInfo'].window),
+                         1)
+
+    def test_adaptive_poll(self):
+        """ Test the poll delay backs off on slow polls and errors """
+        commands = [{'command': 'getNodeInfo'}]
+        poller = iritop.Poller(commands, 2, bounds=(1, 8))
+        self.assertEqual(poller.delay, 2)
+
+        ok, failed = ({}, None, 1), (None, 'timeout', 5000)
+        poller.adapt([ok], 1)
+        self.assertAlmostEqual(poller.delay, 1.6)
+        for i in range(5):
+            poller.adapt([ok], 1)
+        self.assertEqual(poller.delay, 1)
+
+        """ Polls taking over a tenth of the delay are slow """
+        poller.adapt([ok], 150)
+        self.assertEqual(poller.delay, 2)
+        poller.adapt([failed], 5000)
+        poller.adapt([failed], 5000)
+        poller.adapt([failed], 5000)
+        self.assertEqual(poller.delay, 8)
+
+        """ Delay starts within the bounds """
+        poller = iritop.Poller(commands, 2, bounds=(5, 10))
+        self.assertEqual(poller.delay, 5)
+
+    def test_fleet(self):
+        """ Test a fleet polls every node and summarizes it """
+        dead = 'http://127.0.0.1:%d' % testHTTPServer.find_free_port()
+        args = Struct(**dict(self.args, blink_delay=0.5, fleet_workers=2))
+        fleet = iritop.Fleet(args, [iritop.NODE, iritop.NODE + '/b', dead,
+                                    iritop.NODE])
+        self.assertEqual([m.node_url for m in fleet.members],
+                         [iritop.NODE, iritop.NODE + '/b', dead])
+
+        # The dead node fails after its retries within the budget
+        iritop.POLL_BUDGET = 0.5
+        fleet.fleet_poller.start()
+        try:
+            """ Nodes keep up while another one is shown """
+            for i in range(50):
+                fleet.process(skip=0)
+                if (fleet.pollers[0].snapshots.qsize() and
+                        all(m.snapshot_time or m.error
+                            for m in fleet.members[1:])):
+                    break
+                time.sleep(0.1)
+            self.assertIsNone(fleet.members[0].snapshot_time)
+            # Only its first poll, later ones flag incommunicados
+            fleet.members[0].update(fleet.pollers[0].snapshots.get())
+        finally:
+            fleet.fleet_poller.stop()
+            iritop.POLL_BUDGET = None
+
+        summary = [fleet.summary(m, p, 968273)
+                   for m, p in zip(fleet.members, fleet.pollers)]
+        self.assertEqual(summary[0][1:7],
+                         ['1.5.6-RELEASE', 968273, 1, 0, 8, 0])
+        self.assertEqual(summary[0][-1], 'ok')
+        self.assertEqual(summary[1][0], iritop.NODE + '/b')
+        self.assertEqual(summary[2][-1], 'error')
+
+    def test_record_replay(self):
+        """ Test recorded polls replay with their recorded spacing """
+        tmpdir = tempfile.mkdtemp()
+        recording = path.join(tmpdir, 'recording.gz')
+        try:
+            recorder = iritop.Recorder(recording)
+            results = iritop.fetch_concurrent(self.iri_top.commands)
+            for i in range(3):
+                recorder.write(self.iri_top.commands, iritop.Snapshot(
+                    results=tuple(results), duration=5 + i,
+                    time=iritop.monotonic(), timestamp=1000.0 + 10 * i))
+            recorder.close()
+
+            """ Commands are matched by name, missing ones are errors """
+            commands = [{'command': 'getNodeInfo'}, {'command': 'other'}]
+            poller = iritop.ReplayPoller(commands, 10, recording, speed=0)
+            poller.run()
+            snapshots = poller.drain()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual([s.timestamp for s in snapshots],
+                         [1000.0, 1010.0, 1020.0])
+        self.assertEqual([s.duration for s in snapshots], [5, 6, 7])
+        self.assertEqual(snapshots[2].time - snapshots[0].time, 20)
+        self.assertEqual(poller.clock(), snapshots[2].time)
+        self.assertEqual(snapshots[0].results[0][0]['appName'], 'IRI')
+        self.assertIsNone(snapshots[0].results[1][0])
+        self.assertIn('other', snapshots[0].results[1][1])
+
+    def test_shared_cache(self):
+        """ Test only the leader polls, followers read its snapshots """
+        tmpdir = tempfile.mkdtemp()
+        cache = path.join(tmpdir, 'snapshot')
+        fetched = []
+
+        def fetch(name):
+            def fetch_node(commands):
+                fetched.append(name)
+                return iritop.fetch_concurrent(commands)
+            return fetch_node
+
+        commands = [{'command': 'getNodeInfo'}]
+        leader = iritop.SharedPoller(commands, 0.2, cache, iritop.NODE,
+                                     fetch=fetch('leader'))
+        follower = iritop.SharedPoller(commands, 0.2, cache, iritop.NODE,
+                                       fetch=fetch('follower'))
+        try:
+            leader.start()
+            while not leader.leader:
+                time.sleep(0.05)
+            follower.start()
+
+            snapshots = []
+            for i in range(50):
+                snapshots.extend(follower.drain())
+                if len(snapshots) >= 2:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(follower.role, 'follower')
+            self.assertEqual(set(fetched), set(['leader']))
+            self.assertEqual(snapshots[0].results[0][0]['appName'], 'IRI')
+            # Readable by followers of other users
+            self.assertEqual(stat(cache).st_mode & 0o777, 0o644)
+            self.assertIsNone(leader.notice)
+
+            """ A follower takes over when the leader exits """
+            leader.stop()
+            for i in range(50):
+                if follower.leader:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(follower.role, 'leader')
+        finally:
+            leader.stop()
+            follower.stop()
+            shutil.rmtree(tmpdir)
+
+    def test_shared_cache_unusable(self):
+        """ Test polling alone when the shared files cannot be used """
+        cache = path.join(tempfile.mkdtemp(), 'missing', 'snapshot')
+        commands = [{'command': 'getNodeInfo'}]
+        poller = iritop.SharedPoller(commands, 0.2, cache, iritop.NODE)
+        try:
+            self.assertIn('Not sharing snapshots', poller.notice)
+            self.assertEqual(poller.role, 'off')
+            poller.start()
+            snapshots = []
+            for i in range(50):
+                snapshots.extend(poller.drain())
+                if snapshots:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(snapshots[0].results[0][0]['appName'], 'IRI')
+        finally:
+            poller.stop()
+            shutil.rmtree(path.dirname(path.dirname(cache)))
+
+        """ A lock planted as a symlink is not followed """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = path.join(tmpdir, 'snapshot')
+            target = path.join(tmpdir, 'target')
+            symlink(target, cache + '.lock')
+            poller = iritop.SharedPoller(commands, 0.2, cache, iritop.NODE)
+            poller.stop()
+            self.assertEqual(poller.role, 'off')
+            self.assertFalse(path.exists(target))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_agent_viewer(self):
+        """ Test a viewer receives the snapshots polled by an agent """
+        port = testHTTPServer.find_free_port()
+        agent = iritop.Agent('127.0.0.1', port)
+        agent.start()
+        commands = self.iri_top.commands
+        viewer = iritop.ViewerPoller(commands, 1, '127.0.0.1', port)
+        try:
+            sent = []
+            for age in (1, 0):
+                sent.append(iritop.Snapshot(
+                            results=tuple(iritop.fetch_concurrent(commands)),
+                            duration=10, time=iritop.monotonic() - age,
+                            timestamp=time.time() - age))
+            # Connecting after the first snapshot, it is sent in full
+            agent.publish(commands, sent[0], 1)
+            viewer.start()
+            snapshots = []
+            for i in range(50):
+                snapshots.extend(viewer.drain())
+                if snapshots:
+                    break
+                time.sleep(0.1)
+            agent.publish(commands, sent[1], 1)
+            for i in range(50):
+                snapshots.extend(viewer.drain())
+                if len(snapshots) == 2:
+                    break
+                time.sleep(0.1)
+
+            for received, snapshot in zip(snapshots, sent):
+                self.assertEqual(received.results, snapshot.results)
+            self.assertAlmostEqual(snapshots[1].time - snapshots[0].time, 1,
+                                   places=1)
+            self.assertEqual(viewer.node, iritop.NODE)
+
+            self.iri_top.update(snapshots[1])
+            self.iri_top.draw(viewer)
+        finally:
+            viewer.stop()
+            agent.stop()
+
+    def test_headless_record(self):
+        """ Test the JSON record written per poll in headless mode """
+        results = iritop.fetch_concurrent(self.iri_top.commands)
+        snapshot = iritop.Snapshot(results=tuple(results), duration=5,
+                                   time=iritop.monotonic(),
+                                   timestamp=time.time())
+        self.iri_top.update(snapshot)
+        record = json.loads(json.dumps(self.iri_top.record(snapshot)))
+
+        self.assertEqual(record['node']['latestMilestoneIndex'], 968273)
+        self.assertNotIn('coordinatorAddress', record['node'])
+        self.assertEqual(record['latency']['poll'], 5)
+        self.assertEqual(len(record['neighbors']), 2)
+        neighbor = record['neighbors'][0]
+        self.assertEqual(neighbor['address'],
+                         'vmi11111.testserver.net:14600')
+        self.assertEqual(neighbor['numberOfAllTransactions'], 123280)
+        self.assertEqual(neighbor['numberOfAllTransactionsDelta'], 0)
+
+    def test_exporter(self):
+        """ Test metrics are served from memory without polling the node """
+        port = testHTTPServer.find_free_port()
+        exporter = iritop.Exporter('127.0.0.1', port)
+        exporter.start()
+        try:
+            results = iritop.fetch_concurrent(self.iri_top.commands)
+            self.iri_top.update(iritop.Snapshot(
+                results=tuple(results), duration=5,
+                time=iritop.monotonic(), timestamp=time.time()))
+            exporter.publish(self.iri_top.metrics())
+
+            client = iritop.get_client()
+            requests = client.requests
+            http = iritop.urllib3.PoolManager()
+            for i in range(3):
+                response = http.request('GET',
+                                        'http://127.0.0.1:%d/metrics' % port)
+            self.assertEqual(client.requests, requests)
+            self.assertEqual(http.request('GET', 'http://127.0.0.1:%d/x' %
+                                          port).status, 404)
+        finally:
+            exporter.stop()
+
+        metrics = response.data.decode('utf-8')
+        LOG.debug("Metrics: %s" % metrics)
+        self.assertEqual(response.status, 200)
+        self.assertIn('iritop_up{node="%s"} 1.0' % iritop.NODE, metrics)
+        self.assertIn('iri_latest_milestone_index{node="%s"} 968273.0' %
+                      iritop.NODE, metrics)
+        self.assertIn('# TYPE iritop_command_duration_seconds summary',
+                      metrics)
+        self.assertIn('iritop_command_duration_seconds{node="%s",'
+                      'command="getNodeInfo",quantile="0.99"}' % iritop.NODE,
+                      metrics)
+        self.assertIn('iri_neighbor_all_transactions_total{node="%s",'
+                      'neighbor="node03.testserver.nl:15700",'
+                      'connection_type="tcp"} 122298.0' % iritop.NODE,
+                      metrics)
+
+    def test_exporter_partial_poll(self):
+        """ Test a first poll with a failed command only reports up """
+        node, error = iritop.fetch_data({'command': 'getNodeInfo'})
+        self.assertRaises(Exception, self.iri_top.update, iritop.Snapshot(
+            results=((None, 'Unauthorized', 5), (node, None, 5)), duration=5,
+            time=iritop.monotonic(), timestamp=time.time()))
+        self.assertIsNotNone(self.iri_top.node)
+
+        metrics = self.iri_top.metrics(up=False)
+        self.assertEqual(metrics, '# HELP iritop_up Whether the last poll'
+                         ' succeeded\n# TYPE iritop_up gauge\n'
+                         'iritop_up{node="%s"} 0.0\n' % iritop.NODE)
+
+    def test_circuit_breaker(self):
+        """ Test failed fetches are retried until the circuit opens """
+        node = 'http://127.0.0.1:%d' % testHTTPServer.find_free_port()
+        data, error = iritop.fetch_retrying({'command': 'getNodeInfo'},
+                                            node, iritop.monotonic() + 0.5)
+        client = iritop.get_client(node)
+        self.assertIsNone(data)
+        self.assertNotIn('Circuit open', error)
+        self.assertGreater(client.requests, 1)
+        """ The retries of a fetch are a single failure """
+        self.assertEqual(client.failures, 1)
+        self.assertEqual(client.state, 'closed')
+
+        for i in range(iritop.BREAKER_FAILURES - 1):
+            iritop.fetch_retrying({'command': 'getNodeInfo'}, node,
+                                  iritop.monotonic() + 0.1)
+        self.assertEqual(client.state, 'open')
+
+        """ Requests fail right away while the circuit is open """
+        requests = client.requests
+        data, error = iritop.fetch_retrying({'command': 'getNodeInfo'},
+                                            node, iritop.monotonic() + 5)
+        self.assertIn('Circuit open', error)
+        self.assertEqual(client.requests, requests)
+
+        """ Until the cooldown is over """
+        client.open_until = iritop.monotonic()
+        self.assertEqual(client.state, 'half-open')
+
+    def test_hung_node(self):
+        """ Test a node that does not answer is asked again in time """
+        with closing(socket.socket()) as hung:
+            hung.bind(('127.0.0.1', 0))
+            hung.listen(5)
+            node = 'http://127.0.0.1:%d' % hung.getsockname()[1]
+            start = iritop.monotonic()
+            data, error = iritop.fetch_retrying({'command': 'getNodeInfo'},
+                                                node, start + 1)
+        self.assertIsNone(data)
+        self.assertGreater(iritop.get_client(node).requests, 1)
+        self.assertLess(iritop.monotonic() - start, 1.5)
+
+    def test_hedged_request(self):
+        """ Test an alternate endpoint answers when the node is down """
+        alternate = iritop.NODE
+        iritop.NODE = 'http://127.0.0.1:%d' % testHTTPServer.find_free_port()
+        iritop.ALTERNATES = [alternate]
+        try:
+            data, error = iritop.fetch_resilient({'command': 'getNodeInfo'})
+        finally:
+            iritop.ALTERNATES = []
+
+        self.assertIsNone(error)
+        self.assertEqual(data['appName'], 'IRI')
+
+    def test_failed_command(self):
+        """ Test a failed command keeps the data of the others """
+        neighbors, info = iritop.fetch_concurrent(self.iri_top.commands)
+        self.iri_top.update(iritop.Snapshot(
+            results=(neighbors, info), duration=5,
+            time=iritop.monotonic(), timestamp=time.time()))
+        node = self.iri_top.node
+
+        with self.assertRaises(Exception):
+            self.iri_top.update(iritop.Snapshot(
+                results=(neighbors, (None, 'timeout', 5000)), duration=5,
+                time=iritop.monotonic(), timestamp=time.time()))
+        self.assertIs(self.iri_top.node, node)
+        self.assertEqual(self.iri_top.polls, 2)
+
+    def snapshot(self, neighbors=None):
+        """
+        Snapshot of a poll of the test server, with as many neighbors
+        as set instead of the ones of the server
+        """
+        results = iritop.fetch_concurrent(self.iri_top.commands)
+        if neighbors is not None:
+            i = [c['command'] for c in self.iri_top.commands].index(
+                'getNeighbors')
+            results[i] = ({'neighbors': [
+                          {'address': 'n%d:14600' % n,
+                           'connectionType': 'tcp',
+                           'numberOfAllTransactions': n}
+                          for n in range(neighbors)]}, None, 5)
+        return iritop.Snapshot(results=tuple(results), duration=5,
+                               time=iritop.monotonic(),
+                               timestamp=time.time())
+
+    def use_terminal(self, term):
+        """ Draw on term instead of the real terminal """
+        self.iri_top.term = term
+        self.iri_top.screen = iritop.Screen(term, stream=StringIO())
+
+    def test_redraw(self):
+        """ Test a frame is drawn only when the screen can have changed """
+        it = self.iri_top
+        snapshot = self.snapshot()
+        it.clock = lambda: snapshot.time
+
+        def resize():
+            term.size = (30, 100)
+            return ''
+
+        def blink():
+            it.blinking = True
+            return ''
+
+        def lag():
+            it.clock = lambda: snapshot.time + 10 * poller.delay
+            return ''
+
+        term = FakeTerminal(['', '', 'KEY_DOWN', '', resize, '', blink, '',
+                             lag, '', 'q'])
+        poller = FakePoller([[snapshot], [], [], [snapshot]])
+        drawn = []
+        it.draw = lambda poller: drawn.append(poller.drains)
+        self.use_terminal(term)
+        it.loop(poller)
+
+        """ Not on turns 2, 6 and 8: no snapshot, key, resize or blink """
+        self.assertEqual(drawn, [1, 3, 4, 5, 7, 9, 10, 11])
+
+    def test_waiting(self):
+        """ Test the screen is cleared until the first poll completed """
+        it = self.iri_top
+        frames = []
+
+        def frame():
+            frames.append(it.screen.stream.getvalue())
+            it.screen.stream.truncate(0)
+            it.screen.stream.seek(0)
+            return ''
+
+        self.use_terminal(FakeTerminal([frame, frame]))
+        failed = iritop.Snapshot(results=((None, 'Unauthorized', 5),
+                                          (None, 'Unauthorized', 5)),
+                                 duration=5, time=iritop.monotonic(),
+                                 timestamp=time.time())
+        it.loop(FakePoller([[failed]]))
+
+        """ Before any key or snapshot, e.g. coming from the fleet """
+        self.assertIn(it.term.clear, frames[0])
+        self.assertIn('Connecting to %s...' % iritop.NODE, frames[0])
+        self.assertIn('Unauthorized', frames[1])
+
+    def test_scroll(self):
+        """ Test scrolling stays within the neighbors, a page at a time """
+        it = self.iri_top
+        it.clock = iritop.monotonic
+        shown = []
+        show_neighbor = it.show_neighbor
+
+        def show(row, neighbor, *args):
+            shown.append(neighbor)
+            show_neighbor(row, neighbor, *args)
+        it.show_neighbor = show
+
+        pages = []
+
+        def page(key):
+            """ Note the page shown on the last turn, then press key """
+            def note():
+                pages.append((it.scroll, it.page_size, len(shown)))
+                del shown[:]
+                return key
+            return note
+
+        self.use_terminal(FakeTerminal(['', page('KEY_END'),
+                                        page('KEY_PGDOWN'), page(''),
+                                        page('q')]))
+        it.loop(FakePoller([[self.snapshot(neighbors=50)], [], [],
+                            [self.snapshot(neighbors=10)]]))
+
+        """ 12 rows fit, End and PgDn past the end show the last 12 """
+        self.assertEqual(pages, [(0, 12, 12), (38, 12, 12), (38, 12, 12),
+                                 (0, 12, 10)])
+
     def test_bad_request(self):
         """ Test bad request """
         with self.assertRaises(Exception):
@@ -205,6 +1162,79 @@ class TestFetchData(unittest.TestCase):
             result = result
 
 
+class TestScreen(unittest.TestCase):
+
+    def setUp(self):
+        self.out = StringIO()
+        self.term = iritop.Terminal(kind='xterm-256color',
+                                    force_styling=True,
+                                    stream=self.out)
+        self.screen = iritop.Screen(self.term, stream=self.out)
+
+    def flush(self):
+        self.out.seek(0)
+        self.out.truncate()
+        self.screen.flush()
+        return self.out.getvalue()
+
+    def test_unchanged_frame(self):
+        """ Test an identical frame writes nothing """
+        for i in range(2):
+            self.screen.write(1, 0, 'Tips:')
+            self.screen.write(1, 18, self.term.cyan('3601'))
+            output = self.flush()
+
+        self.assertEqual(output, '')
+        self.assertEqual(self.screen.frame_bytes, 0)
+
+    def test_changed_cells(self):
+        """ Test only changed text is written, shorter text is padded """
+        self.screen.write(1, 0, 'Tips:')
+        self.screen.write(1, 18, '3601')
+        self.screen.write(2, 0, 'Gone')
+        self.assertIn(self.term.clear, self.flush())
+
+        self.screen.write(1, 0, 'Tips:')
+        self.screen.write(1, 18, '99')
+        output = self.flush()
+
+        self.assertNotIn('Tips:', output)
+        self.assertIn(self.term.move(1, 18) + '99  ', output)
+        self.assertIn(self.term.move(2, 0) + '    ', output)
+        self.assertEqual(self.screen.frame_bytes, len(output.encode()))
+
+    def test_overlapping_text(self):
+        """ Test unchanged text overwritten by a change is redrawn """
+        self.screen.write(1, 0, 'Load: 0.1')
+        self.screen.write(1, 5, 'Next')
+        self.flush()
+
+        self.screen.write(1, 0, 'Load: 0.2')
+        self.screen.write(1, 5, 'Next')
+        output = self.flush()
+
+        self.assertTrue(output.endswith(self.term.move(1, 5) + 'Next'))
+
+    def test_single_write(self):
+        """ Test a frame is written at once, wrapped in sync updates """
+        writes = []
+        self.out.write = writes.append
+        self.screen.sync = True
+        for row in range(20):
+            self.screen.write(row, 0, 'Row %d' % row)
+        self.screen.flush()
+
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].startswith('\x1b[?2026h'))
+        self.assertTrue(writes[0].endswith('\x1b[?2026l'))
+
+        """ Nothing is written if nothing changed """
+        for row in range(20):
+            self.screen.write(row, 0, 'Row %d' % row)
+        self.screen.flush()
+        self.assertEqual(len(writes), 1)
+
+
 # END TEST CASES
 
 
@@ -250,6 +1280,9 @@ def check_auth(func):
 
 class HTTPHandler(BaseHTTPRequestHandler):
 
+    # Keep-alive support
+    protocol_version = 'HTTP/1.1'
+
     def refuse(self, address=None, reason=None, code=401):
         LOG.warning("HTTP: Client refused with '%s': %s" %
                     (reason, address))
@@ -282,7 +1315,7 @@ class HTTPHandler(BaseHTTPRequestHandler):
         # help mimic real API port query over time
         if data['command'] == 'getNeighbors':
             code = 200
-            response = [{
+            response = {"duration": 0, "neighbors": [{
                 "address": "vmi11111.testserver.net:14600",
                 "connectionType": "udp",
                 "numberOfAllTransactions": 123280,
@@ -300,7 +1333,7 @@ class HTTPHandler(BaseHTTPRequestHandler):
                 "numberOfRandomTransactionRequests": 1095,
                 "numberOfSentTransactions": 109190,
                 "numberOfStaleTransactions": 3798
-            }]
+            }]}
         elif data['command'] == 'getNodeInfo':
             code = 200
             response = {
@@ -344,14 +1377,23 @@ class HTTPHandler(BaseHTTPRequestHandler):
         self.do_response(code=code, response=response)
 
     def do_response(self, response=None, code=200):
-        self._set_headers(code)
-        self.wfile.write(json.dumps(response).encode())
+        body = json.dumps(response).encode()
+        self._set_headers(code, len(body))
+        self.wfile.write(body)
 
-    def _set_headers(self, code):
+    def _set_headers(self, code, length=0):
         self.send_response(code)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(length))
         self.end_headers()
 
+    def log_message(self, format, *args):
+        LOG.debug("HTTP: " + format % args)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
 
 """ HTTP test server """
 
@@ -362,7 +1404,7 @@ class testHTTPServer():
         self.server_address = (bind_address, bind_port)
 
     def serve_until_shutdown(self):
-        self.httpd = HTTPServer(self.server_address, HTTPHandler)
+        self.httpd = ThreadedHTTPServer(self.server_address, HTTPHandler)
         while True:
             self.httpd.handle_request()
 
@@ -391,6 +1433,56 @@ class Struct:
         self.__dict__.update(entries)
 
 
+class FakeTerminal(iritop.Terminal):
+    """
+    Terminal of a given size reading keys from a list: characters,
+    KEY_* names, or callables returning one of them (e.g. to resize
+    the terminal in between). Q once the list is over.
+    """
+
+    def __init__(self, keys, height=24, width=120):
+        super(FakeTerminal, self).__init__(kind='xterm-256color',
+                                           force_styling=True,
+                                           stream=StringIO())
+        self.keys = list(keys)
+        self.size = (height, width)
+
+    @property
+    def height(self):
+        return self.size[0]
+
+    @property
+    def width(self):
+        return self.size[1]
+
+    def inkey(self, timeout=None):
+        key = self.keys.pop(0) if self.keys else 'q'
+        if callable(key):
+            key = key()
+        if key.startswith('KEY_'):
+            # The sequence stands in for the escape sequence of the key
+            return Keystroke(key, code=getattr(self, key), name=key)
+        return Keystroke(key)
+
+
+class FakePoller(object):
+    """ Poller publishing a list of snapshots per drain """
+    delay = 1
+    bounds = None
+    role = None
+    notice = None
+    node = None
+    polling_since = None
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.drains = 0
+
+    def drain(self):
+        self.drains += 1
+        return self.batches.pop(0) if self.batches else []
+
+
 if __name__ == '__main__':
     logging.basicConfig(stream=sys.stderr,
                         format='[%(levelname)s] %(message)s')